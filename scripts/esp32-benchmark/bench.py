@@ -0,0 +1,464 @@
+# Host-Benchmark für den Microdot-Webserver der ESP32-Lichtschranke.
+#
+# Startet die App aus main.py unter CPython auf 127.0.0.1. Die
+# MicroPython-Module machine, ujson und uasyncio kommen dabei aus stubs/.
+# Gleichzeitige Clients mit und ohne Keep-Alive messen Anfragen pro Sekunde
+# und die Latenz (p50/p95/p99). Zusätzlich werden die Allokationen pro
+# Anfrage mit tracemalloc gemessen. Die Ergebnisse werden als JSON
+# gespeichert und können mit einer früheren Messung verglichen werden:
+#
+#   python scripts/esp32-benchmark/bench.py
+#   python scripts/esp32-benchmark/bench.py --save scripts/esp32-benchmark/baselines/cpython-loopback.json
+#   python scripts/esp32-benchmark/bench.py --compare scripts/esp32-benchmark/baselines/cpython-loopback.json
+#
+# Die absoluten Zahlen hängen vom Rechner ab. Vergleiche sind nur mit
+# Messungen auf demselben Rechner aussagekräftig.
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(HERE, "..", "..", "src", "backend", "arduino", "ESP32",
+                       "projects", "Lichtschranke")
+STUBS_DIR = os.path.join(HERE, "stubs")
+RESULT_MARKER = "BENCH-RESULT "
+
+# Name -> (Methode, Pfad, Header, Body, erwarteter Status); "{etag}" wird
+# durch das aktuelle ETag von /current ersetzt. /participant ändert den
+# Zustand und läuft deshalb zuletzt.
+SCENARIOS = [
+    ("current", ("GET", "/current", {}, b"", 200)),
+    ("current-304", ("GET", "/current", {"If-None-Match": "{etag}"}, b"", 304)),
+    ("simple-status", ("GET", "/simple-status", {}, b"", 200)),
+    ("index-gzip", ("GET", "/", {"Accept-Encoding": "gzip"}, b"", 200)),
+    ("results", ("GET", "/results?limit=20", {}, b"", 200)),
+    ("not-found", ("GET", "/missing", {}, b"", 404)),
+    ("participant", ("POST", "/participant",
+                     {"Content-Type": "application/json"},
+                     b'{"dog_id": "7", "dog_name": "Rex", "club_id": "12"}', 200)),
+]
+MODES = ("keep-alive", "close")
+
+
+# --- Server (läuft in einem eigenen Prozess) ---
+
+def install_stubs():
+    sys.dont_write_bytecode = True
+    sys.path.insert(0, STUBS_DIR)
+    sys.path.insert(0, APP_DIR)
+    # Tick-Funktionen von MicroPython (30 Bit, mit Überlauf)
+    t0 = time.perf_counter_ns()
+
+    def ticks_us():
+        return ((time.perf_counter_ns() - t0) // 1000) & 0x3fffffff
+
+    def ticks_ms():
+        return ((time.perf_counter_ns() - t0) // 1000000) & 0x3fffffff
+
+    def ticks_diff(end, start):
+        diff = (end - start) & 0x3fffffff
+        return diff - 0x40000000 if diff >= 0x20000000 else diff
+
+    time.ticks_us = ticks_us
+    time.ticks_ms = ticks_ms
+    time.ticks_diff = ticks_diff
+    time.ticks_add = lambda ticks, delta: (ticks + delta) & 0x3fffffff
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+
+
+def make_workdir():
+    # Arbeitsverzeichnis mit den statischen Dateien und Beispielergebnissen,
+    # damit die Ergebnisdateien im Projekt unverändert bleiben. Die
+    # Beispiele liegen im alten JSONL-Format und werden beim Import von
+    # main.py nach results.bin übernommen.
+    workdir = tempfile.mkdtemp(prefix="esp32-bench-")
+    shutil.copytree(os.path.join(APP_DIR, "static"),
+                    os.path.join(workdir, "static"))
+    with open(os.path.join(workdir, "results.jsonl"), "w") as f:
+        for i in range(50):
+            f.write(json.dumps({
+                "device": "esp32-01", "dog_id": str(i), "dog_name": "Hund %d" % i,
+                "club_id": "12", "lane": None, "start_ms": 1000 * i,
+                "finish_ms": 1000 * i + 4321, "elapsed_ms": 4321,
+                "timestamp_received_ms": 1000 * i + 4321}) + "\n")
+    return workdir
+
+
+def load_app(workdir):
+    install_stubs()
+    os.chdir(workdir)
+    import main
+    return main
+
+
+def serve(port, workdir):
+    main = load_app(workdir)
+
+    async def run():
+        await main.app.start_server(host="127.0.0.1", port=port)
+
+    asyncio.run(run())
+
+
+class FakeReader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    async def readinto(self, buf):
+        n = min(len(buf), len(self.data) - self.pos)
+        buf[:n] = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+class FakeWriter:
+    def __init__(self):
+        self.size = 0
+
+    async def awrite(self, data):
+        self.size += len(data)
+
+    async def aclose(self):
+        pass
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 50000)
+
+
+def measure_request(app, raw):
+    # eine Anfrage ohne Event-Loop abarbeiten; Leser, Schreiber und
+    # Coroutine werden vor der Messung angelegt
+    reader = FakeReader(raw)
+    writer = FakeWriter()
+    coro = app.handle_request(reader, writer)
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    try:
+        coro.send(None)
+    except StopIteration:
+        pass
+    else:
+        coro.close()
+        raise RuntimeError("Anfrage wurde nicht ohne Warten beantwortet")
+    peak = tracemalloc.get_traced_memory()[1]
+    if not writer.size:
+        raise RuntimeError("keine Antwort geschrieben")
+    return peak - before
+
+
+def measure_allocations(workdir, count):
+    main = load_app(workdir)
+    results = {}
+    tracemalloc.start()
+    for name, scenario in SCENARIOS:
+        headers = dict(scenario[2])
+        if headers.get("If-None-Match") == "{etag}":
+            headers["If-None-Match"] = '"%d"' % main.state_version
+        raw = build_request(scenario[0], scenario[1], headers, scenario[3],
+                            keep_alive=False)
+        for _ in range(20):
+            measure_request(main.app, raw)
+        # was nach allen Anfragen noch belegt ist, wird nicht freigegeben;
+        # das Array belegt beim Eintragen keinen zusätzlichen Speicher
+        peaks = array("q", bytes(8 * count))
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(count):
+            peaks[i] = measure_request(main.app, raw)
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - before
+        peaks = sorted(peaks)
+        results[name] = {
+            "peak_bytes": peaks[len(peaks) // 2],
+            "retained_bytes": round(retained / count, 1),
+        }
+    tracemalloc.stop()
+    print(RESULT_MARKER + json.dumps(results))
+
+
+# --- Lastgenerator ---
+
+def build_request(method, path, headers, body, keep_alive=True):
+    lines = ["%s %s HTTP/1.1" % (method, path), "Host: 192.168.4.1"]
+    for name, value in headers.items():
+        lines.append("%s: %s" % (name, value))
+    if body:
+        lines.append("Content-Length: %d" % len(body))
+    if not keep_alive:
+        lines.append("Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head[9:12])
+    headers = {}
+    for line in head.split(b"\r\n")[1:]:
+        if b":" in line:
+            name, value = line.split(b":", 1)
+            headers[name.strip().lower()] = value.strip()
+    if b"content-length" in headers:
+        await reader.readexactly(int(headers[b"content-length"]))
+    elif headers.get(b"transfer-encoding") == b"chunked":
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    return status, headers
+
+
+async def client(port, raw, expected, count, keep_alive, latencies, errors):
+    reader = writer = None
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(raw)
+            status, headers = await read_response(reader)
+        except (OSError, asyncio.IncompleteReadError):
+            errors[0] += 1
+            if writer is not None:
+                writer.close()
+            writer = None
+            continue
+        latencies.append(time.perf_counter() - start)
+        if status != expected:
+            errors[0] += 1
+        if not keep_alive or headers.get(b"connection") == b"close":
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def fetch_etag(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(build_request("GET", "/current", {}, b"", keep_alive=False))
+    status, headers = await read_response(reader)
+    writer.close()
+    return headers.get(b"etag", b"").decode()
+
+
+def percentile(values, p):
+    # Nearest-Rank auf der sortierten Liste
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+async def run_round(port, raw, expected, requests, concurrency, keep_alive):
+    latencies = []
+    errors = [0]
+    per_client = requests // concurrency
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        client(port, raw, expected, per_client, keep_alive, latencies, errors)
+        for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "errors": errors[0],
+    }
+
+
+async def run_load(port, requests, concurrency, rounds):
+    results = {}
+    for name, (method, path, headers, body, expected) in SCENARIOS:
+        headers = dict(headers)
+        if headers.get("If-None-Match") == "{etag}":
+            headers["If-None-Match"] = await fetch_etag(port)
+        results[name] = {}
+        for mode in MODES:
+            keep_alive = mode == "keep-alive"
+            raw = build_request(method, path, headers, body, keep_alive)
+            # Aufwärmen, damit Caches und Pools gefüllt sind
+            await asyncio.gather(*[
+                client(port, raw, expected, 10, keep_alive, [], [0])
+                for _ in range(concurrency)])
+            # Median mehrerer Durchläufe, einzelne Ausreißer durch andere
+            # Prozesse auf dem Rechner fallen so weniger ins Gewicht
+            runs = []
+            for _ in range(rounds):
+                runs.append(await run_round(port, raw, expected, requests,
+                                            concurrency, keep_alive))
+            stats = {}
+            for key in ("rps", "p50_ms", "p95_ms", "p99_ms"):
+                stats[key] = sorted(run[key] for run in runs)[len(runs) // 2]
+            stats["errors"] = sum(run["errors"] for run in runs)
+            results[name][mode] = stats
+            print("%-14s %-10s %8.1f req/s  p50 %6.2f ms  p95 %6.2f ms  "
+                  "p99 %6.2f ms  Fehler %d" % (
+                      name, mode, stats["rps"], stats["p50_ms"],
+                      stats["p95_ms"], stats["p99_ms"], stats["errors"]))
+    return results
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Server startet nicht auf Port %d" % port)
+
+
+def run_child(args, **kwargs):
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)] + args,
+                            **kwargs)
+
+
+def benchmark(requests, concurrency, rounds, alloc_requests):
+    workdir = make_workdir()
+    try:
+        port = free_port()
+        server = run_child(["--serve", str(port), workdir])
+        try:
+            wait_for_port(port)
+            load = asyncio.run(run_load(port, requests, concurrency, rounds))
+        finally:
+            server.terminate()
+            server.wait()
+
+        # Allokationen in einem frischen Prozess mit neuem Zustand messen
+        child = run_child(["--alloc", str(alloc_requests), workdir],
+                          stdout=subprocess.PIPE, universal_newlines=True)
+        output = child.communicate()[0]
+        if child.returncode:
+            raise RuntimeError("Allokationsmessung fehlgeschlagen")
+        allocations = None
+        for line in output.splitlines():
+            if line.startswith(RESULT_MARKER):
+                allocations = json.loads(line[len(RESULT_MARKER):])
+        for name, values in allocations.items():
+            print("%-14s %8d Bytes Spitze pro Anfrage, %6.1f Bytes bleiben" % (
+                name, values["peak_bytes"], values["retained_bytes"]))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": time.strftime("%Y-%m-%d"),
+            "requests": requests,
+            "concurrency": concurrency,
+            "rounds": rounds,
+            "alloc_requests": alloc_requests,
+        },
+        "load": load,
+        "allocations": allocations,
+    }
+
+
+def flatten(result):
+    # (Bezeichnung, Wert, Richtung): 1 wenn ein größerer Wert besser ist, -1
+    # wenn ein kleinerer besser ist, 0 für Werte, die auf einem Rechner mit
+    # anderen Prozessen zu stark schwanken, um als Verschlechterung zu gelten
+    values = []
+    for name, modes in result["load"].items():
+        for mode, stats in modes.items():
+            label = "%s/%s " % (name, mode)
+            values.append((label + "rps", stats["rps"], 1))
+            values.append((label + "p50_ms", stats["p50_ms"], -1))
+            values.append((label + "p95_ms", stats["p95_ms"], 0))
+            values.append((label + "p99_ms", stats["p99_ms"], 0))
+    for name, stats in result["allocations"].items():
+        values.append(("%s peak_bytes" % name, stats["peak_bytes"], -1))
+    return values
+
+
+def compare(result, baseline, threshold, alloc_threshold):
+    # Abweichungen in die falsche Richtung melden, die größer als die
+    # erlaubten Prozent sind; die Allokationen schwanken kaum und haben
+    # deshalb eine eigene, kleinere Grenze
+    old = {label: value for label, value, _ in flatten(baseline)}
+    regressions = 0
+    print("\nVergleich mit der Basismessung vom %s:" % baseline["meta"]["date"])
+    for label, value, direction in flatten(result):
+        if label not in old or not old[label]:
+            continue
+        change = (value - old[label]) / old[label] * 100
+        limit = alloc_threshold if label.endswith("_bytes") else threshold
+        flag = ""
+        if direction and -direction * change > limit:
+            flag = "  <-- schlechter"
+            regressions += 1
+        print("%-36s %12s -> %12s  %+6.1f %%%s" % (
+            label, old[label], value, change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark des Microdot-Webservers der Lichtschranke")
+    parser.add_argument("--requests", type=int, default=2000,
+                        help="Anfragen pro Szenario und Modus")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="gleichzeitige Verbindungen")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="Durchläufe pro Szenario, gemeldet wird der Median")
+    parser.add_argument("--alloc-requests", type=int, default=200,
+                        help="Anfragen pro Szenario für die Allokationsmessung")
+    parser.add_argument("--save", metavar="JSON",
+                        help="Ergebnis als Basismessung speichern")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="mit einer gespeicherten Basismessung vergleichen")
+    parser.add_argument("--threshold", type=float, default=25,
+                        help="erlaubte Verschlechterung von Durchsatz und "
+                             "Latenz in Prozent")
+    parser.add_argument("--alloc-threshold", type=float, default=5,
+                        help="erlaubte Zunahme der Allokationen in Prozent")
+    parser.add_argument("--serve", nargs=2, metavar=("PORT", "DIR"),
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--alloc", nargs=2, metavar=("N", "DIR"),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(int(args.serve[0]), args.serve[1])
+        return 0
+    if args.alloc:
+        measure_allocations(args.alloc[1], int(args.alloc[0]))
+        return 0
+
+    result = benchmark(args.requests, args.concurrency, args.rounds,
+                       args.alloc_requests)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+            f.write("\n")
+        print("gespeichert: %s" % args.save)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.threshold, args.alloc_threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,22 @@
+# Ersatz für das MicroPython-Modul machine, damit main.py unter CPython
+# importiert werden kann. Die Pins liefern immer den Ruhepegel, Interrupts
+# werden nur gespeichert.
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 2
+    PULL_DOWN = 3
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=IN, pull=None):
+        self.id = id
+        self.handler = None
+
+    def irq(self, trigger=None, handler=None, hard=False):
+        self.handler = handler
+
+    def value(self, *args):
+        return 1
@@ -0,0 +1,2 @@
+# Ersatz für uasyncio unter CPython
+from asyncio import *  # noqa: F401,F403
@@ -0,0 +1,2 @@
+# Ersatz für ujson unter CPython
+from json import *  # noqa: F401,F403
@@ -0,0 +1,93 @@
+# Belastungstest für die Warteschlange der Worker-Threads (_WorkQueue in
+# microdot.py) unter CPython.
+#
+# Mehrere Produzenten und Worker legen gleichzeitig Einträge ab und holen
+# sie wieder heraus. Geprüft wird, dass jeder Eintrag genau einmal ankommt,
+# kein Worker mit einer Exception endet und alle Worker am Ende noch laufen.
+#
+#   python scripts/esp32-benchmark/workqueue_stress.py
+#   python scripts/esp32-benchmark/workqueue_stress.py --items 200000 --workers 4
+import argparse
+import os
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(HERE, "..", "..", "src", "backend", "arduino", "ESP32",
+                       "projects", "Lichtschranke")
+
+
+def run(items, workers, producers, size):
+    from microdot import _WorkQueue
+    queue = _WorkQueue(size)
+    seen = bytearray(items)
+    errors = []
+    stopped = []
+
+    def worker():
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                seen[item] += 1
+        except Exception as exc:
+            errors.append(repr(exc))
+        else:
+            stopped.append(1)
+
+    def producer(first):
+        for item in range(first, items, producers):
+            # volle Warteschlange: wie der Server erneut versuchen
+            while not queue.put(item):
+                time.sleep(0)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    feeders = [threading.Thread(target=producer, args=(i,))
+               for i in range(producers)]
+    for thread in feeders:
+        thread.start()
+    for thread in feeders:
+        thread.join()
+
+    deadline = time.time() + 60
+    while sum(1 for n in seen if n) < items and time.time() < deadline \
+            and not errors:
+        time.sleep(0.05)
+    alive = sum(1 for thread in threads if thread.is_alive())
+    for _ in threads:
+        queue.put(None, force=True)
+    for thread in threads:
+        thread.join(5)
+
+    missing = sum(1 for n in seen if n == 0)
+    duplicated = sum(1 for n in seen if n > 1)
+    print("Einträge %d, fehlend %d, doppelt %d, Worker aktiv %d/%d, "
+          "beendet %d, Fehler %s" % (items, missing, duplicated, alive,
+                                     workers, len(stopped), errors or "-"))
+    return not missing and not duplicated and not errors \
+        and alive == workers and len(stopped) == workers
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Belastungstest für _WorkQueue in microdot.py")
+    parser.add_argument("--items", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--producers", type=int, default=2)
+    parser.add_argument("--size", type=int, default=4,
+                        help="Plätze in der Warteschlange")
+    args = parser.parse_args()
+    sys.dont_write_bytecode = True
+    sys.path.insert(0, APP_DIR)
+    # häufige Threadwechsel, damit Wettlaufsituationen auch auftreten
+    sys.setswitchinterval(1e-6)
+    ok = run(args.items, args.workers, args.producers, args.size)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
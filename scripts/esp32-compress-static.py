@@ -0,0 +1,28 @@
+# Erzeugt die vorkomprimierten .gz-Dateien für die statischen Seiten der
+# ESP32-Lichtschranke. Nach jeder Änderung an static/ ausführen und die
+# .gz-Dateien zusammen mit den Originalen auf den ESP32 hochladen.
+#
+#   python scripts/esp32-compress-static.py
+import gzip
+import os
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "backend",
+                          "arduino", "ESP32", "projects", "Lichtschranke",
+                          "static")
+EXTENSIONS = (".html", ".css", ".js", ".json", ".txt")
+
+
+def compress(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    # mtime=0, damit unveränderte Dateien byte-identisch bleiben
+    packed = gzip.compress(data, compresslevel=9, mtime=0)
+    with open(path + ".gz", "wb") as f:
+        f.write(packed)
+    print("%s: %d -> %d Bytes" % (os.path.relpath(path), len(data), len(packed)))
+
+
+if __name__ == "__main__":
+    for name in sorted(os.listdir(STATIC_DIR)):
+        if name.endswith(EXTENSIONS):
+            compress(os.path.join(STATIC_DIR, name))
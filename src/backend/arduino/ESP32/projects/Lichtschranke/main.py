@@ -1,44 +1,94 @@
 # main.py – Minimaler Webserver für ESP32 (MicroPython)
 
 # Kombinierte Webserver- und Lichtschranken-API
-from microdot import Microdot, Response
+from microdot_asyncio import Microdot, Response
+from microdot_asyncio_sse import EventChannel
+from microdot_asyncio_websocket import WebSocket, with_websocket
+from microdot_metrics import Metrics
+from array import array
 import machine
+import os
+import struct
 import time
 import ujson
-import os
+import uasyncio as asyncio
+
+try:
+  import micropython
+  # Fehler in Interrupt-Handlern trotzdem melden können
+  micropython.alloc_emergency_exception_buf(100)
+except ImportError:
+  pass
+
+try:
+  from mqtt_client import MQTTHandler
+except ImportError:
+  MQTTHandler = None
 
 Response.default_content_type = "application/json"
 app = Microdot()
+# Verbindungspuffer, Request- und Response-Objekte wiederverwenden, damit
+# das Polling von /current kaum Speicher belegt und der GC seltener läuft
+app.pool_size = 2
+# Unter dieser Grenze freien Speichers antworten Anfragen mit 503, damit
+# kein MemoryError während eines Laufs auftritt; /manual/start und
+# /manual/stop sind davon ausgenommen
+app.min_free_memory = 16 * 1024
+
+# Live-Ereignisse (start, finish, reset, participant, sensor) für /events
+events = EventChannel()
+
+def encode_ws_event(data=None, event=None, event_id=None):
+  return ujson.dumps({"event": event, "data": data})
+
+# Stumme /ws-Clients (z.B. Handy außer Reichweite des Access Points) nach
+# 20 s anpingen und ohne Antwort nach weiteren 10 s trennen, damit Socket,
+# Task und Abonnement freigegeben werden
+WebSocket.ping_interval = 20
+WebSocket.ping_timeout = 10
+
+# Dieselben Ereignisse als JSON-Nachrichten für /ws (ohne Keepalive-Kommentare)
+ws_events = EventChannel(keepalive=None, encoder=encode_ws_event)
+
+def encode_version(data=None, event=None, event_id=None):
+  return event_id
+
+# Weckt Long-Poll-Anfragen an /current, liefert nur die neue Version
+changes = EventChannel(max_queue=1, keepalive=None, encoder=encode_version)
+
+# Wird bei jedem Zustandswechsel erhöht (ETag und ?since= von /current)
+state_version = 0
+
+def notify(event, data):
+  global state_version
+  state_version += 1
+  events.publish(event, data, event_id=state_version)
+  ws_events.publish(event, data)
+  changes.publish(event, data, event_id=state_version)
 
 
 # --- Lichtschranken-API-Endpunkte und Logik ---
-PIN_SENSOR = 33
-PIN_MANUAL_START = 25
-PIN_MANUAL_STOP = 26
+# Bahnen: Nummer, Pin der Start-Lichtschranke, Pin der Ziel-Lichtschranke
+# (None: eine Lichtschranke für Start und Ziel), Pins der Taster für
+# manuellen Start/Stopp (None ohne Taster).
+# Eine zweite Bahn z.B. mit (2, 32, None, 27, 14)
+LANES = (
+  (1, 33, None, 25, 26),
+)
 DEBOUNCE_MS = 10
 MIN_ELAPSED_MS = 500
 MAX_ELAPSED_MS = 600000
-RESULTS_FILE = "results.jsonl"
+# Nur mit getrennter Ziel-Lichtschranke: Mindestabstand zwischen zwei
+# Starts und Höchstzahl gleichzeitig laufender Hunde pro Bahn
+MIN_START_SPACING_MS = 2000
+MAX_RUNS_IN_FLIGHT = 8
+RESULTS_FILE = "results.bin"
+# Ergebnisdatei früherer Versionen, wird beim Start nach RESULTS_FILE übernommen
+LEGACY_RESULTS_FILE = "results.jsonl"
+LONG_POLL_MAX_MS = 25000
+STARTLIST_MAX = 100
 DEVICE_NAME = "esp32-01"
 
-state = "idle"
-sensor_enabled = True
-manual_active = False
-last_trigger = 0
-start_ts_us = 0
-finish_ts_us = 0
-current_participant = None
-
-pin_sensor = machine.Pin(PIN_SENSOR, machine.Pin.IN, machine.Pin.PULL_UP)
-
-hardware_buttons_available = False
-try:
-  pin_manual_start = machine.Pin(PIN_MANUAL_START, machine.Pin.IN, machine.Pin.PULL_UP)
-  pin_manual_stop = machine.Pin(PIN_MANUAL_STOP, machine.Pin.IN, machine.Pin.PULL_UP)
-  hardware_buttons_available = True
-except Exception:
-  hardware_buttons_available = False
-
 def micros_now():
   return time.ticks_us()
 
@@ -48,39 +98,254 @@ def ms_from_us(us):
 def elapsed_ms_from_us(start_us, end_us):
   return time.ticks_diff(end_us, start_us) // 1000
 
-def save_result(result):
+# --- Ergebnisdatei ---
+# Kopf (Kennung, Version, Satzgröße, Gerät) und danach Datensätze fester
+# Größe. Datensatz K liegt bei RESULTS_HEADER_SIZE + K * RESULT_SIZE, damit
+# die letzten N Ergebnisse oder ein einzelnes per seek gelesen werden, ohne
+# die Datei zu parsen. Zeiten in µs (ticks_us), None als NO_VALUE.
+RESULTS_MAGIC = b"LSR1"
+RESULTS_VERSION = 1
+RESULTS_HEADER = "<4sHH16s"
+RESULTS_HEADER_SIZE = struct.calcsize(RESULTS_HEADER)
+# seq, start_us, finish_us, elapsed_ms, received_ms, lane, flags,
+# dog_id, club_id, dog_name
+RESULT_RECORD = "<IIIIIBB16s16s26s"
+RESULT_SIZE = struct.calcsize(RESULT_RECORD)
+RESULT_ID_SIZE = 16
+RESULT_NAME_SIZE = 26
+RESULT_MANUAL = 1
+RESULT_DOG_ID_INT = 2
+RESULT_CLUB_ID_INT = 4
+NO_VALUE = 0xffffffff
+
+# Zahl der vollständigen Datensätze (None: noch nicht ermittelt) und
+# Gerätename aus dem Dateikopf
+result_count = None
+results_device = DEVICE_NAME
+result_buffer = bytearray(RESULT_SIZE)
+
+def pack_text(value, size):
+  # Auf size Bytes kürzen, ohne ein UTF-8-Zeichen zu zerschneiden; neue
+  # Namen weist participant_error vorher ab, gekürzt werden nur übernommene
+  if value is None:
+    return b""
+  data = str(value).encode()
+  if len(data) > size:
+    end = size
+    while end and data[end] & 0xc0 == 0x80:
+      end -= 1
+    data = data[:end]
+  return data
+
+def pack_id(value):
+  # IDs werden nie gekürzt, sonst zeigten sie auf einen anderen Hund
+  if value is None:
+    return b""
+  data = str(value).encode()
+  if len(data) > RESULT_ID_SIZE:
+    raise ValueError("id too long")
+  return data
+
+def participant_error(payload):
+  # Zu lange IDs und Namen schon bei der Eingabe abweisen, damit das
+  # gespeicherte Ergebnis dem angezeigten entspricht; IDs sind Text oder
+  # Zahl, true/false würde als Zahl gespeichert
+  for key in ("dog_id", "club_id"):
+    value = payload.get(key)
+    if value is None:
+      continue
+    if type(value) is not str and type(value) is not int:
+      return {"error": key + "_invalid"}
+    if len(str(value).encode()) > RESULT_ID_SIZE:
+      return {"error": key + "_too_long", "max_bytes": RESULT_ID_SIZE}
+  value = payload.get("dog_name")
+  if value is not None and len(str(value).encode()) > RESULT_NAME_SIZE:
+    return {"error": "dog_name_too_long", "max_bytes": RESULT_NAME_SIZE}
+  return None
+
+def unpack_text(data, is_int):
+  text = data.rstrip(b"\0").decode()
+  if not text:
+    return None
+  if is_int:
+    # ein unlesbarer Eintrag darf nicht das ganze Ergebnislog blockieren
+    try:
+      return int(text)
+    except ValueError:
+      pass
+  return text
+
+def or_no_value(value):
+  return NO_VALUE if value is None else value
+
+def pack_result(buf, seq, result, start_us, finish_us):
+  flags = RESULT_MANUAL if result.get("manual") else 0
+  if type(result.get("dog_id")) is int:
+    flags |= RESULT_DOG_ID_INT
+  if type(result.get("club_id")) is int:
+    flags |= RESULT_CLUB_ID_INT
+  struct.pack_into(RESULT_RECORD, buf, 0, seq,
+                   or_no_value(start_us), or_no_value(finish_us),
+                   or_no_value(result.get("elapsed_ms")),
+                   or_no_value(result.get("timestamp_received_ms")),
+                   result.get("lane") or 0, flags,
+                   pack_id(result.get("dog_id")),
+                   pack_id(result.get("club_id")),
+                   pack_text(result.get("dog_name"), RESULT_NAME_SIZE))
+
+def unpack_result(buf):
+  (seq, start_us, finish_us, elapsed_ms, received_ms, lane, flags,
+   dog_id, club_id, dog_name) = struct.unpack_from(RESULT_RECORD, buf)
+  return {
+    "seq": seq,
+    "device": results_device,
+    "dog_id": unpack_text(dog_id, flags & RESULT_DOG_ID_INT),
+    "dog_name": unpack_text(dog_name, False),
+    "club_id": unpack_text(club_id, flags & RESULT_CLUB_ID_INT),
+    "lane": lane or None,
+    "start_ms": None if start_us == NO_VALUE else ms_from_us(start_us),
+    "finish_ms": None if finish_us == NO_VALUE else ms_from_us(finish_us),
+    "elapsed_ms": None if elapsed_ms == NO_VALUE else elapsed_ms,
+    "manual": bool(flags & RESULT_MANUAL),
+    "timestamp_received_ms": None if received_ms == NO_VALUE else received_ms
+  }
+
+def results_header(device=DEVICE_NAME):
+  return struct.pack(RESULTS_HEADER, RESULTS_MAGIC, RESULTS_VERSION, RESULT_SIZE, device.encode())
+
+def count_results():
+  # Legt die Datei bei Bedarf an. Ein beim Stromausfall abgeschnittener
+  # letzter Datensatz zählt nicht und wird beim nächsten Speichern überschrieben
+  global result_count, results_device
+  if result_count is not None:
+    return result_count
   try:
-    with open(RESULTS_FILE, "a") as f:
-      f.write(ujson.dumps(result) + "\n")
+    with open(RESULTS_FILE, "rb") as f:
+      header = f.read(RESULTS_HEADER_SIZE)
+  except OSError:
+    header = b""
+  if len(header) < RESULTS_HEADER_SIZE:
+    # neue Datei, oder das Anlegen wurde unterbrochen
+    with open(RESULTS_FILE, "wb") as f:
+      f.write(results_header())
+    result_count = 0
+    return result_count
+  magic, version, size, device = struct.unpack(RESULTS_HEADER, header)
+  if magic != RESULTS_MAGIC or version != RESULTS_VERSION or size != RESULT_SIZE:
+    # fremde Datei beiseitelegen statt sie zu überschreiben
+    print("Ergebnisdatei in unbekanntem Format, umbenannt in %s.bad" % RESULTS_FILE)
+    os.rename(RESULTS_FILE, RESULTS_FILE + ".bad")
+    return count_results()
+  results_device = device.rstrip(b"\0").decode()
+  result_count = (os.stat(RESULTS_FILE)[6] - RESULTS_HEADER_SIZE) // RESULT_SIZE
+  return result_count
+
+def save_result(result, start_us=None, finish_us=None):
+  global result_count
+  try:
+    seq = count_results()
+    pack_result(result_buffer, seq, result, start_us, finish_us)
+    with open(RESULTS_FILE, "r+b") as f:
+      f.seek(RESULTS_HEADER_SIZE + seq * RESULT_SIZE)
+      f.write(result_buffer)
+    result_count = seq + 1
     return True
   except Exception as e:
     print("Speichern fehlgeschlagen:", e)
     return False
 
-def load_all_results(limit=None):
-  results = []
+def iter_results(first=0, count=None):
+  # Datensätze ab Nummer first per seek lesen, einer nach dem anderen
+  total = count_results()
+  end = total if count is None else min(total, first + count)
+  if first < 0 or first >= end:
+    return
+  buf = bytearray(RESULT_SIZE)
+  with open(RESULTS_FILE, "rb") as f:
+    f.seek(RESULTS_HEADER_SIZE + first * RESULT_SIZE)
+    for _ in range(first, end):
+      if f.readinto(buf) != RESULT_SIZE:
+        return
+      yield unpack_result(buf)
+
+def stream_results(limit=None):
+  # JSON-Liste stückweise erzeugen, wird als chunked Response gesendet
+  total = count_results()
+  count = min(total, limit) if limit and limit > 0 else total
+  yield '{"count": %d, "total": %d, "results": [' % (count, total)
+  sep = ""
+  for result in iter_results(total - count):
+    yield sep
+    yield ujson.dumps(result)
+    sep = ", "
+  yield "]}"
+
+def export_results(first=0):
+  # JSONL-Export, eine Zeile pro Ergebnis
+  for result in iter_results(first):
+    yield ujson.dumps(result) + "\n"
+
+def iter_legacy_results():
+  # Zeilen der alten JSONL-Datei; abgeschnittene Zeilen (z.B. nach
+  # Stromausfall) werden übersprungen
+  with open(LEGACY_RESULTS_FILE, "r") as f:
+    for line in f:
+      line = line.strip()
+      if not line.startswith("{") or not line.endswith("}"):
+        continue
+      try:
+        yield ujson.loads(line)
+      except ValueError:
+        continue
+
+def migrate_results():
+  # results.jsonl einmalig übernehmen; erst in eine temporäre Datei, damit
+  # ein Neustart mittendrin keine doppelten Ergebnisse erzeugt
   try:
-    if not RESULTS_FILE in os.listdir():
-      return results
-  except Exception:
-    pass
+    os.stat(LEGACY_RESULTS_FILE)
+  except OSError:
+    return
   try:
-    with open(RESULTS_FILE, "r") as f:
-      for line in f:
-        line = line.strip()
-        if not line:
-          continue
+    os.stat(RESULTS_FILE)
+  except OSError:
+    tmp = RESULTS_FILE + ".tmp"
+    seq = 0
+    skipped = 0
+    with open(tmp, "wb") as f:
+      f.write(results_header())
+      for i, result in enumerate(iter_legacy_results()):
+        # Einträge, die nicht in einen Datensatz passen (Bahn außerhalb
+        # 0-255, negative oder zu große Werte, zu lange IDs), überspringen
+        # statt die ganze Übernahme abzubrechen
         try:
-          results.append(ujson.loads(line))
-        except Exception:
+          try:
+            result["lane"] = int(result.get("lane") or 0)
+          except (TypeError, ValueError):
+            result["lane"] = None
+          start_ms = result.get("start_ms")
+          finish_ms = result.get("finish_ms")
+          pack_result(result_buffer, seq, result,
+                      None if start_ms is None else int(start_ms) * 1000,
+                      None if finish_ms is None else int(finish_ms) * 1000)
+          name = result.get("dog_name")
+          if name is not None and len(str(name).encode()) > RESULT_NAME_SIZE:
+            print("Eintrag %d aus %s: Name auf %d Bytes gekürzt: %s" % (i, LEGACY_RESULTS_FILE, RESULT_NAME_SIZE, name))
+        except Exception as e:
+          print("Eintrag %d aus %s übersprungen: %r" % (i, LEGACY_RESULTS_FILE, e))
+          skipped += 1
           continue
-  except Exception as e:
-    print("Fehler beim Laden results:", e)
-  if limit:
-    return results[-limit:]
-  return results
+        f.write(result_buffer)
+        seq += 1
+    os.rename(tmp, RESULTS_FILE)
+    print("%d Ergebnisse aus %s übernommen, %d übersprungen" % (seq, LEGACY_RESULTS_FILE, skipped))
+  os.rename(LEGACY_RESULTS_FILE, LEGACY_RESULTS_FILE + ".bak")
+
+try:
+  migrate_results()
+except Exception as e:
+  print("Übernahme von %s fehlgeschlagen: %s" % (LEGACY_RESULTS_FILE, e))
 
-def make_result_payload(start_us, finish_us, participant, device=DEVICE_NAME):
+def make_result_payload(start_us, finish_us, participant, lane=None, manual=False, device=DEVICE_NAME):
   now_ms = ms_from_us(micros_now())
   elapsed_ms = elapsed_ms_from_us(start_us, finish_us) if start_us and finish_us else None
   result = {
@@ -88,322 +353,579 @@ def make_result_payload(start_us, finish_us, participant, device=DEVICE_NAME):
     "dog_id": participant.get("dog_id") if participant else None,
     "dog_name": participant.get("dog_name") if participant else None,
     "club_id": participant.get("club_id") if participant else None,
-    "lane": participant.get("lane") if participant else None,
+    "lane": lane,
     "start_ms": ms_from_us(start_us) if start_us else None,
     "finish_ms": ms_from_us(finish_us) if finish_us else None,
     "elapsed_ms": elapsed_ms,
+    "manual": manual,
     "timestamp_received_ms": now_ms
   }
   return result
 
-def reset_run():
-  global start_ts_us, finish_ts_us, state, manual_active, current_participant
-  start_ts_us = 0
-  finish_ts_us = 0
-  state = "idle"
-  manual_active = False
-  current_participant = None
-
-def sensor_callback(pin):
-  global state, start_ts_us, finish_ts_us, last_trigger, sensor_enabled, manual_active, current_participant
-  if not sensor_enabled:
-    print("Sensor deaktiviert - kein Trigger")
-    return
-  if manual_active:
-    print("Manueller Lauf aktiv - Sensor ignoriert")
-    return
-  now = micros_now()
-  if time.ticks_diff(now, last_trigger) < DEBOUNCE_MS * 1000:
-    print("Debounce - Trigger ignoriert")
-    return
-  last_trigger = now
-  if state == "idle":
-    start_ts_us = now
-    state = "running"
-    print("Lichtschranke: START erkannt (ts_us=%d)" % start_ts_us)
-  elif state == "running":
-    if time.ticks_diff(now, start_ts_us) // 1000 >= MIN_ELAPSED_MS:
-      finish_ts_us = now
-      result = make_result_payload(start_ts_us, finish_ts_us, current_participant)
-      saved = save_result(result)
-      print("Lichtschranke: ZIEL erkannt (ts_us=%d, elapsed=%d ms)" % (finish_ts_us, elapsed_ms_from_us(start_ts_us, finish_ts_us)))
-      state = "idle"
-      manual_active = False
-      current_participant = None
+def make_participant(payload, lane):
+  dog_id = payload.get("dog_id")
+  dog_name = payload.get("dog_name")
+  if not dog_id and not dog_name:
+    return None
+  return {
+    "dog_id": dog_id,
+    "dog_name": dog_name,
+    "club_id": payload.get("club_id"),
+    "lane": lane
+  }
+
+class Run:
+  # Ein Lauf zwischen Start- und Ziel-Lichtschranke
+  def __init__(self, start_us, participant, from_startlist, manual):
+    self.start_us = start_us
+    self.participant = participant
+    self.from_startlist = from_startlist
+    self.manual = manual
+
+class Lane:
+  # Laufzustand einer Bahn mit eigenen Lichtschranken, Entprellung und
+  # Teilnehmer; mehrere Bahnen laufen unabhängig voneinander. Mit getrennter
+  # Start- und Ziel-Lichtschranke können mehrere Hunde gleichzeitig auf der
+  # Strecke sein, das Ziel wird dann immer dem ältesten Lauf zugeordnet.
+  def __init__(self, number, separate_gates=False):
+    self.number = number
+    self.separate_gates = separate_gates
+    self.state = "idle"
+    self.sensor_enabled = True
+    self.manual_active = False
+    # letzte Auslösung von Start (0) und Ziel (1) für die Entprellung
+    self.last_trigger = [0, 0]
+    # Laufende Läufe, ältester zuerst
+    self.runs = []
+    # Start, Ziel und Teilnehmer des zuletzt beendeten Laufs
+    self.start_ts_us = 0
+    self.finish_ts_us = 0
+    self.last_participant = None
+    # Teilnehmer für den nächsten Start
+    self.participant = None
+    # Startliste; nach jedem Start wird der nächste Teilnehmer bereitgestellt
+    self.queue = []
+    self.from_startlist = False
+    # Antwort von /current pro Version, ändert sich nur bei Zustandswechseln
+    self.cache_version = -1
+    self.cache_body = b""
+
+  def bounced(self, now, gate):
+    if time.ticks_diff(now, self.last_trigger[gate]) < DEBOUNCE_MS * 1000:
+      return True
+    self.last_trigger[gate] = now
+    return False
+
+  def gate_ready(self, now, gate):
+    if not self.sensor_enabled:
+      print("Bahn %d: Sensor deaktiviert - kein Trigger" % self.number)
+      return False
+    if self.manual_active and not self.separate_gates:
+      # mit getrennten Lichtschranken laufen Sensor- und manuelle Läufe
+      # nebeneinander, das Ziel beendet dann nur Sensor-Läufe
+      print("Bahn %d: Manueller Lauf aktiv - Sensor ignoriert" % self.number)
+      return False
+    if self.bounced(now, gate):
+      print("Bahn %d: Debounce - Trigger ignoriert" % self.number)
+      return False
+    return True
+
+  def runs_changed(self):
+    self.state = "running" if self.runs else "idle"
+    self.manual_active = False
+    for run in self.runs:
+      if run.manual:
+        self.manual_active = True
+
+  def expire_runs(self, now):
+    # Hunde, die das Ziel nie erreichen, würden sonst alle folgenden
+    # Zieldurchläufe dem falschen Lauf zuordnen
+    while self.runs and time.ticks_diff(now, self.runs[0].start_us) // 1000 > MAX_ELAPSED_MS:
+      run = self.runs.pop(0)
+      self.runs_changed()
+      notify("timeout", {"lane": self.number, "start_ms": ms_from_us(run.start_us), "participant": run.participant})
+
+  def start_error(self, now):
+    if self.separate_gates:
+      self.expire_runs(now)
+    if not self.runs:
+      return None
+    if not self.separate_gates:
+      return "already running"
+    if len(self.runs) >= MAX_RUNS_IN_FLIGHT:
+      return "too_many_runs"
+    if time.ticks_diff(now, self.runs[-1].start_us) // 1000 < MIN_START_SPACING_MS:
+      return "start_spacing_not_reached"
+    return None
+
+  def finishing_run(self, now, manual):
+    # Das Ziel beendet den ältesten Sensor-Lauf, der Stopp den ältesten
+    # manuellen Lauf und ohne einen solchen den ältesten Lauf überhaupt
+    if self.separate_gates:
+      self.expire_runs(now)
+    for run in self.runs:
+      if run.manual == manual:
+        return run
+    if manual and self.runs:
+      return self.runs[0]
+    return None
+
+  def finish_error(self, now, run):
+    if run is None:
+      return "no active run"
+    if time.ticks_diff(now, run.start_us) // 1000 < MIN_ELAPSED_MS:
+      return "min_elapsed_not_reached"
+    return None
+
+  def start(self, now, manual):
+    run = Run(now, self.participant, self.from_startlist, manual)
+    self.runs.append(run)
+    self.runs_changed()
+    self.participant = None
+    self.from_startlist = False
+    notify("start", {
+      "lane": self.number,
+      "start_ms": ms_from_us(now),
+      "manual": manual,
+      "participant": run.participant,
+      "in_flight": len(self.runs)
+    })
+    self.arm_next()
+
+  def finish(self, now, run):
+    self.runs.remove(run)
+    self.runs_changed()
+    self.start_ts_us = run.start_us
+    self.finish_ts_us = now
+    self.last_participant = run.participant
+    result = make_result_payload(run.start_us, now, run.participant, self.number, run.manual)
+    save_result(result, run.start_us, now)
+    notify("finish", result)
+    return result
+
+  def reset(self):
+    # Teilnehmer aus der Startliste kommen für einen neuen Versuch wieder
+    # nach vorne, von Hand gesetzte werden verworfen
+    back = [run.participant for run in self.runs if run.from_startlist]
+    if self.from_startlist:
+      back.append(self.participant)
+    self.queue = back + self.queue
+    self.participant = None
+    self.from_startlist = False
+    self.runs = []
+    self.runs_changed()
+    self.start_ts_us = 0
+    self.finish_ts_us = 0
+    self.last_participant = None
+    notify("reset", {"lane": self.number, "state": self.state})
+    self.arm_next()
+
+  def sensor_triggered(self, now):
+    # gemeinsame Lichtschranke für Start und Ziel
+    if not self.gate_ready(now, 0):
+      return
+    if self.state == "idle":
+      self.start_triggered(now, checked=True)
     else:
-      print("Ziel zu früh erkannt - ignoriert")
+      self.finish_triggered(now, checked=True)
 
-pin_sensor.irq(trigger=machine.Pin.IRQ_FALLING, handler=sensor_callback)
+  def start_triggered(self, now, checked=False):
+    if not checked and not self.gate_ready(now, 0):
+      return
+    error = self.start_error(now)
+    if error:
+      print("Bahn %d: Start ignoriert (%s)" % (self.number, error))
+      return
+    self.start(now, False)
+    print("Bahn %d: START erkannt (ts_us=%d)" % (self.number, now))
 
+  def finish_triggered(self, now, checked=False):
+    if not checked and not self.gate_ready(now, 1):
+      return
+    run = self.finishing_run(now, False)
+    error = self.finish_error(now, run)
+    if error:
+      print("Bahn %d: Ziel ignoriert (%s)" % (self.number, error))
+      return
+    result = self.finish(now, run)
+    print("Bahn %d: ZIEL erkannt (ts_us=%d, elapsed=%d ms)" % (self.number, now, result["elapsed_ms"]))
 
-def manual_start_button_cb(pin):
-    manual_start_via_hw()
+  def start_pressed(self, now):
+    if self.bounced(now, 0) or self.start_error(now):
+      return
+    self.start(now, True)
 
-def manual_stop_button_cb(pin):
-    manual_stop_via_hw()
+  def stop_pressed(self, now):
+    if self.bounced(now, 1):
+      return
+    run = self.finishing_run(now, True)
+    if self.finish_error(now, run):
+      return
+    self.finish(now, run)
 
-def manual_start_via_hw():
-    global state, start_ts_us, manual_active, last_trigger
+  def start_manual(self):
     now = micros_now()
-    if time.ticks_diff(now, last_trigger) < DEBOUNCE_MS * 1000:
-        return
-    last_trigger = now
-    if state == "running":
-        return
-    start_ts_us = now
-    state = "running"
-    manual_active = True
+    error = self.start_error(now)
+    if error:
+      return {"error": error}
+    participant = self.participant
+    self.start(now, True)
+    return {"status": "manual_start", "lane": self.number, "start_ms": ms_from_us(now), "participant": participant}
 
-def manual_stop_via_hw():
-    global state, finish_ts_us, manual_active, start_ts_us, current_participant, last_trigger
+  def stop_manual(self):
     now = micros_now()
-    if time.ticks_diff(now, last_trigger) < DEBOUNCE_MS * 1000:
-        return
-    last_trigger = now
-    if state != "running":
-        return
-    if time.ticks_diff(now, start_ts_us)//1000 >= MIN_ELAPSED_MS:
-        finish_ts_us = now
-        result = make_result_payload(start_ts_us, finish_ts_us, current_participant)
-        save_result(result)
-        state = "idle"
-        manual_active = False
-        current_participant = None
-
-if hardware_buttons_available:
-  pin_manual_start.irq(trigger=machine.Pin.IRQ_FALLING, handler=manual_start_button_cb)
-  pin_manual_stop.irq(trigger=machine.Pin.IRQ_FALLING, handler=manual_stop_button_cb)
+    run = self.finishing_run(now, True)
+    error = self.finish_error(now, run)
+    if error:
+      return {"error": error}
+    result = self.finish(now, run)
+    return {"status": "manual_stop", "lane": self.number, "finish_ms": ms_from_us(now), "elapsed_ms": result["elapsed_ms"], "result": result}
+
+  def set_participant(self, payload):
+    participant = make_participant(payload, self.number)
+    if participant is None:
+      return {"error": "dog_id or dog_name required"}
+    if self.from_startlist:
+      # verdrängten Teilnehmer wieder vorne in die Startliste stellen
+      self.queue.insert(0, self.participant)
+      self.from_startlist = False
+    self.participant = participant
+    notify("participant", self.participant)
+    return {"status": "participant_set", "participant": self.participant}
+
+  def arm_next(self):
+    if self.participant is not None or not self.queue:
+      return
+    self.participant = self.queue.pop(0)
+    self.from_startlist = True
+    notify("participant", self.participant)
+
+  def startlist(self):
+    return {"lane": self.number, "participant": self.participant, "queue": self.queue}
+
+  def startlist_changed(self):
+    self.arm_next()
+    notify("startlist", self.startlist())
+    return self.startlist()
+
+  def set_startlist(self, entries, append=False):
+    queue = self.queue if append else []
+    if len(queue) + len(entries) > STARTLIST_MAX:
+      return {"error": "startlist_too_long", "max": STARTLIST_MAX}
+    participants = []
+    for i, entry in enumerate(entries):
+      participant = make_participant(entry, self.number) if isinstance(entry, dict) else None
+      if participant is None:
+        return {"error": "dog_id or dog_name required", "index": i}
+      participants.append(participant)
+    self.queue = queue + participants
+    return self.startlist_changed()
+
+  def skip(self, index=None):
+    # ohne index den bereitgestellten Teilnehmer überspringen
+    if index is None:
+      if self.participant is None:
+        return {"error": "no participant"}
+      self.participant = None
+      self.from_startlist = False
+    elif 0 <= index < len(self.queue):
+      self.queue.pop(index)
+    else:
+      return {"error": "invalid index"}
+    return self.startlist_changed()
+
+  def move(self, src, dst):
+    if not 0 <= src < len(self.queue) or not 0 <= dst < len(self.queue):
+      return {"error": "invalid index"}
+    self.queue.insert(dst, self.queue.pop(src))
+    return self.startlist_changed()
+
+  def set_sensor(self, enabled):
+    self.sensor_enabled = enabled
+    notify("sensor", {"lane": self.number, "sensor_enabled": enabled})
+    return {"lane": self.number, "sensor_enabled": enabled}
+
+  def status(self):
+    # läuft ein Lauf, zeigt der Status den ältesten, sonst den zuletzt
+    # beendeten samt dessen Teilnehmer; der bereitgestellte Teilnehmer für
+    # den nächsten Start steht nur unter "next"
+    now = micros_now()
+    if self.separate_gates:
+      # abgebrochene Läufe nicht erst beim nächsten Trigger verwerfen
+      self.expire_runs(now)
+    if self.runs:
+      run = self.runs[0]
+      participant = run.participant
+      start_us = run.start_us
+      finish_us = 0
+      elapsed = elapsed_ms_from_us(start_us, now)
+    else:
+      participant = self.last_participant
+      start_us = self.start_ts_us
+      finish_us = self.finish_ts_us
+      elapsed = elapsed_ms_from_us(start_us, finish_us) if start_us and finish_us else None
+    status = {
+      "version": state_version,
+      "lane": self.number,
+      "state": self.state,
+      "sensor_active": self.sensor_enabled,
+      "manual_active": self.manual_active,
+      "participant": participant,
+      "next": self.participant,
+      "queued": len(self.queue),
+      "in_flight": len(self.runs),
+      "start": ms_from_us(start_us) if start_us else 0,
+      "finish": ms_from_us(finish_us) if finish_us else 0,
+      "elapsed": elapsed
+    }
+    if self.separate_gates:
+      status["runs"] = [{
+        "participant": run.participant,
+        "manual": run.manual,
+        "start": ms_from_us(run.start_us),
+        "elapsed": elapsed_ms_from_us(run.start_us, now)
+      } for run in self.runs]
+    return status
+
+  def current_body(self):
+    if self.state == "running":
+      # elapsed läuft weiter, daher nicht zwischenspeichern
+      return self.status()
+    if self.cache_version != state_version:
+      self.cache_body = ujson.dumps(self.status()).encode()
+      self.cache_version = state_version
+    return self.cache_body
+
+# --- Trigger aus Interrupts ---
+# Die Interrupt-Handler schreiben nur Zeitstempel (ticks_us) und Pin in einen
+# vorab angelegten Ringpuffer; Zustandswechsel, Speichern und Benachrichtigen
+# erledigt process_triggers() in der Event-Loop. So bleibt die Zeitmessung
+# exakt und kurz aufeinanderfolgende Unterbrechungen gehen nicht verloren.
+TRIGGER_BUFFER_SIZE = 16
+trigger_ticks = array("L", [0] * TRIGGER_BUFFER_SIZE)
+trigger_pins = array("B", [0] * TRIGGER_BUFFER_SIZE)
+trigger_head = 0
+trigger_tail = 0
+triggers_dropped = 0
+
+try:
+  trigger_flag = asyncio.ThreadSafeFlag()
+except AttributeError:
+  # CPython (Benchmark) kennt kein ThreadSafeFlag, dort gibt es keine Interrupts
+  trigger_flag = asyncio.Event()
+
+def push_trigger(pin_id):
+  # Läuft im (harten) Interrupt: nichts allozieren, nichts ausgeben
+  global trigger_head, triggers_dropped
+  now = time.ticks_us()
+  head = trigger_head
+  nxt = (head + 1) % TRIGGER_BUFFER_SIZE
+  if nxt == trigger_tail:
+    triggers_dropped += 1
+    return
+  trigger_ticks[head] = now
+  trigger_pins[head] = pin_id
+  trigger_head = nxt
+  trigger_flag.set()
+
+def trigger_handler(pin_id):
+  # Eigener Handler pro Pin, der Interrupt übergibt nur das Pin-Objekt
+  def handler(pin):
+    push_trigger(pin_id)
+  return handler
+
+# Pin -> Methode der Bahn, aufgerufen von process_triggers()
+trigger_targets = {}
+
+def attach_trigger(pin_id, target):
+  pin = machine.Pin(pin_id, machine.Pin.IN, machine.Pin.PULL_UP)
+  pin.irq(trigger=machine.Pin.IRQ_FALLING, handler=trigger_handler(pin_id), hard=True)
+  trigger_targets[pin_id] = target
+
+async def process_triggers():
+  global trigger_tail, triggers_dropped
+  while True:
+    await trigger_flag.wait()
+    trigger_flag.clear()
+    if triggers_dropped:
+      print("Trigger-Puffer voll - %d Trigger verworfen" % triggers_dropped)
+      triggers_dropped = 0
+    while trigger_tail != trigger_head:
+      tail = trigger_tail
+      target = trigger_targets.get(trigger_pins[tail])
+      now = trigger_ticks[tail]
+      trigger_tail = (tail + 1) % TRIGGER_BUFFER_SIZE
+      if target is not None:
+        target(now)
+
+lanes = {}
+
+def setup_lanes():
+  for number, pin_start_gate, pin_finish_gate, pin_start, pin_stop in LANES:
+    lane = Lane(number, separate_gates=pin_finish_gate is not None)
+    lanes[number] = lane
+    if pin_finish_gate is None:
+      attach_trigger(pin_start_gate, lane.sensor_triggered)
+    else:
+      attach_trigger(pin_start_gate, lane.start_triggered)
+      attach_trigger(pin_finish_gate, lane.finish_triggered)
+    if pin_start is not None:
+      try:
+        attach_trigger(pin_start, lane.start_pressed)
+        attach_trigger(pin_stop, lane.stop_pressed)
+      except Exception:
+        print("Bahn %d: keine Taster für manuellen Start/Stopp" % number)
+
+setup_lanes()
+
+DEFAULT_LANE = LANES[0][0]
+UNKNOWN_LANE = {"error": "unknown lane"}, 404
+
+def find_lane(number=None):
+  # Bahn aus ?lane=, Payload oder WebSocket-Befehl; ohne Angabe die erste
+  if number is None or number == "":
+    return lanes[DEFAULT_LANE]
+  try:
+    return lanes.get(int(number))
+  except (TypeError, ValueError):
+    return None
 
 # --- API Endpunkte ---
 
 # --- Webserver-Startseite ---
+# Die Seite liegt in static/index.html, vorkomprimiert in static/index.html.gz
+# (erzeugt mit scripts/esp32-compress-static.py)
+INDEX_FILE = "static/index.html"
+STATIC_MAX_AGE = 600
+
 @app.route('/')
 def index(request):
-  html = """
-  <!DOCTYPE html>
-  <html lang='de'>
-  <head>
-  <meta charset='UTF-8'>
-  <meta name='viewport' content='width=device-width, initial-scale=1.0'>
-  <title>ESP32 Lichtschranke</title>
-  <style>
-    body { font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif; background: #f0f2f5; margin: 0; padding: 0; display: flex; justify-content: center; align-items: center; min-height: 100vh; }
-    .container { width: 100%; max-width: 500px; padding: 20px; }
-    header { text-align: center; margin-bottom: 20px; }
-    header h1 { color: #1c1e21; font-size: 24px; }
-    footer { text-align: center; margin-top: 20px; color: #8a8d91; font-size: 12px; }
-    .card { background: #fff; border-radius: 8px; box-shadow: 0 2px 4px rgba(0, 0, 0, .1), 0 8px 16px rgba(0, 0, 0, .1); padding: 20px; margin-bottom: 20px; }
-    .info-card p { margin: 5px 0; color: #606770; }
-    .stopwatch-card h3 { text-align: center; color: #1c1e21; margin-top: 0; }
-    #stopwatch-display { font-family: "Menlo", "Consolas", "Monaco", monospace; font-size: 3em; text-align: center; color: #1c1e21; margin: 20px 0; }
-    .button-container { display: flex; justify-content: space-around; gap: 10px; }
-    .button-container button { flex-grow: 1; border: none; border-radius: 6px; padding: 12px; font-size: 16px; font-weight: bold; cursor: pointer; transition: background-color 0.2s; }
-    #start-btn { background-color: #42b72a; color: white; }
-    #start-btn:hover:not(:disabled) { background-color: #36a420; }
-    #stop-btn { background-color: #fa3e3e; color: white; }
-    #stop-btn:hover:not(:disabled) { background-color: #e03030; }
-    #reset-btn { background-color: #6c757d; color: white; }
-    #reset-btn:hover:not(:disabled) { background-color: #5a6268; }
-    button:disabled { background-color: #ccd0d5; color: #8a8d91; cursor: not-allowed; }
-    .toggle-container { display: flex; justify-content: space-between; align-items: center; padding: 10px; background-color: #f0f2f5; border-radius: 6px; margin-bottom: 20px; }
-    .switch { position: relative; display: inline-block; width: 50px; height: 28px; }
-    .switch input { opacity: 0; width: 0; height: 0; }
-    .slider { position: absolute; cursor: pointer; top: 0; left: 0; right: 0; bottom: 0; background-color: #ccc; transition: .4s; border-radius: 28px; }
-    .slider:before { position: absolute; content: ""; height: 20px; width: 20px; left: 4px; bottom: 4px; background-color: white; transition: .4s; border-radius: 50%; }
-    input:checked + .slider { background-color: #1877f2; }
-    input:checked + .slider:before { transform: translateX(22px); }
-    #status-message { text-align: center; margin-top: 15px; font-weight: bold; }
-  </style>
-  </head>
-  <body>
-  <div class="container">
-    <header><h1>ESP32 Lichtschranke</h1></header>
-    <main>
-      <div class="card stopwatch-card">
-        <h3>Manuelle Zeitmessung</h3>
-        <div class="toggle-container">
-          <label for="manual-mode-switch">Manuelle Messung</label>
-          <label class="switch">
-            <input type="checkbox" id="manual-mode-switch">
-            <span class="slider"></span>
-          </label>
-        </div>
-        <div id="stopwatch-display">00:00:00.000</div>
-        <div class="button-container">
-          <button id="start-btn" disabled>Start</button>
-          <button id="stop-btn" disabled>Stop</button>
-          <button id="reset-btn" disabled>Reset</button>
-        </div>
-        <p id="status-message"></p>
-      </div>
-      <div class="card info-card">
-        <p><b>Status:</b> Verbunden</p>
-        <p><b>API:</b> <a href="/simple-status">/simple-status</a></p>
-      </div>
-    </main>
-    <footer>&copy; 2025 DogTraining ESP32</footer>
-  </div>
-
-  <script>
-    document.addEventListener('DOMContentLoaded', () => {
-      const manualModeSwitch = document.getElementById('manual-mode-switch');
-      const startBtn = document.getElementById('start-btn');
-      const stopBtn = document.getElementById('stop-btn');
-      const resetBtn = document.getElementById('reset-btn');
-      const display = document.getElementById('stopwatch-display');
-      const statusMessage = document.getElementById('status-message');
-
-      let timer = null;
-      let startTime = 0;
-      let running = false;
-
-      function updateDisplay() {
-        const elapsed = Date.now() - startTime;
-        const minutes = String(Math.floor(elapsed / 60000)).padStart(2, '0');
-        const seconds = String(Math.floor((elapsed % 60000) / 1000)).padStart(2, '0');
-        const milliseconds = String(elapsed % 1000).padStart(3, '0');
-        display.textContent = `${minutes}:${seconds}:${milliseconds}`;
-      }
-
-      function setStatus(message, isError = false) {
-        statusMessage.textContent = message;
-        statusMessage.style.color = isError ? '#fa3e3e' : '#42b72a';
-      }
-
-      function updateButtonStates(isManualMode, isRunning) {
-          startBtn.disabled = !isManualMode || isRunning;
-          stopBtn.disabled = !isManualMode || !isRunning;
-          resetBtn.disabled = !isManualMode || isRunning;
-      }
-
-      manualModeSwitch.addEventListener('change', () => {
-        const isManual = manualModeSwitch.checked;
-        if (!isManual && running) {
-            // If toggled off during a run, stop and reset everything
-            clearInterval(timer);
-            timer = null;
-            running = false;
-            display.textContent = '00:00:00.000';
-            setStatus('Manuelle Messung deaktiviert.');
-        }
-        updateButtonStates(isManual, running);
-      });
-
-      startBtn.addEventListener('click', async () => {
-        setStatus('Starte Messung...');
-        try {
-          const response = await fetch('/manual/start', { method: 'POST' });
-          const data = await response.json();
-          if (response.ok && data.status === 'manual_start') {
-            startTime = Date.now();
-            running = true;
-            timer = setInterval(updateDisplay, 10);
-            updateButtonStates(true, true);
-            setStatus('Messung läuft...');
-          } else {
-            setStatus(data.error || 'Start fehlgeschlagen', true);
-          }
-        } catch (e) {
-          setStatus('Fehler: Keine Verbindung', true);
-        }
-      });
-
-      stopBtn.addEventListener('click', async () => {
-        setStatus('Stoppe Messung...');
-        try {
-          const response = await fetch('/manual/stop', { method: 'POST' });
-          const data = await response.json();
-          if (response.ok && data.status === 'manual_stop') {
-            clearInterval(timer);
-            timer = null;
-            running = false;
-            const finalTime = data.elapsed_ms;
-            const minutes = String(Math.floor(finalTime / 60000)).padStart(2, '0');
-            const seconds = String(Math.floor((finalTime % 60000) / 1000)).padStart(2, '0');
-            const milliseconds = String(finalTime % 1000).padStart(3, '0');
-            display.textContent = `${minutes}:${seconds}:${milliseconds}`;
-            updateButtonStates(true, false);
-            setStatus(`Gestoppt: ${finalTime} ms`);
-          } else {
-            setStatus(data.error || 'Stop fehlgeschlagen', true);
-          }
-        } catch (e) {
-          setStatus('Fehler: Keine Verbindung', true);
-        }
-      });
-
-      resetBtn.addEventListener('click', async () => {
-          setStatus('Setze zurück...');
-          try {
-            // Also call the backend reset to be safe
-            const response = await fetch('/reset', { method: 'POST' });
-            if(response.ok) {
-                running = false;
-                clearInterval(timer);
-                timer = null;
-                display.textContent = '00:00:00.000';
-                updateButtonStates(true, false);
-                setStatus('Bereit für neue Messung.');
-            } else {
-                setStatus('Reset fehlgeschlagen', true);
-            }
-          } catch(e) {
-              setStatus('Fehler: Keine Verbindung', true);
-          }
-      });
-      
-      // Initial state
-      updateButtonStates(false, false);
-    });
-  </script>
-  </body>
-  </html>
-  """
-  return Response(html, headers={"Content-Type": "text/html"})
+  gzip = "gzip" in request.headers.get("Accept-Encoding", "")
+  try:
+    res = Response.send_file(INDEX_FILE, compressed=gzip,
+                             file_extension=".gz" if gzip else "",
+                             max_age=STATIC_MAX_AGE, request=request)
+  except OSError:
+    # ohne .gz-Datei die unkomprimierte Seite senden
+    res = Response.send_file(INDEX_FILE, max_age=STATIC_MAX_AGE, request=request)
+  res.headers["Vary"] = "Accept-Encoding"
+  return res
 
 @app.route("/participant", methods=['POST'])
 def set_participant(request):
-  global current_participant, state
   try:
     payload = request.json
   except Exception:
-    return ujson.dumps({"error": "invalid json"})
+    return {"error": "invalid json"}
   if not payload:
-    return ujson.dumps({"error": "no payload"})
-  dog_id = payload.get("dog_id")
-  dog_name = payload.get("dog_name")
-  club_id = payload.get("club_id")
-  lane = payload.get("lane", None)
-  if not dog_id and not dog_name:
-    return ujson.dumps({"error": "dog_id or dog_name required"})
-  if state == "running":
-    return ujson.dumps({"error": "run_active"})
-  current_participant = {
-    "dog_id": dog_id,
-    "dog_name": dog_name,
-    "club_id": club_id,
-    "lane": lane
-  }
-  return ujson.dumps({"status": "participant_set", "participant": current_participant})
+    return {"error": "no payload"}
+  error = participant_error(payload)
+  if error:
+    return error, 400
+  lane = find_lane(payload.get("lane", request.args.get("lane")))
+  if lane is None:
+    return UNKNOWN_LANE
+  return lane.set_participant(payload)
+
+# Startliste pro Bahn: nach jedem Start (und nach /reset) wird automatisch
+# der nächste Teilnehmer bereitgestellt, ohne POST /participant dazwischen
+@app.route("/startlist")
+def get_startlist(request):
+  lane = find_lane(request.args.get("lane"))
+  if lane is None:
+    return UNKNOWN_LANE
+  return lane.startlist()
+
+@app.route("/startlist", methods=['POST'])
+def set_startlist(request):
+  # [{"dog_name": ...}, ...] oder {"participants": [...], "append": true}
+  try:
+    payload = request.json
+  except Exception:
+    return {"error": "invalid json"}
+  append = False
+  if isinstance(payload, dict):
+    append = bool(payload.get("append"))
+    payload = payload.get("participants")
+  if not isinstance(payload, list):
+    return {"error": "participants required"}, 400
+  for i, entry in enumerate(payload):
+    error = participant_error(entry) if isinstance(entry, dict) else None
+    if error:
+      error["index"] = i
+      return error, 400
+  lane = find_lane(request.args.get("lane"))
+  if lane is None:
+    return UNKNOWN_LANE
+  return lane.set_startlist(payload, append=append)
+
+@app.route("/startlist/skip", methods=['POST'])
+def skip_startlist(request):
+  # ohne Body den bereitgestellten Teilnehmer, mit {"index": i} einen Eintrag
+  lane = find_lane(request.args.get("lane"))
+  if lane is None:
+    return UNKNOWN_LANE
+  try:
+    payload = request.json or {}
+    index = payload.get("index")
+    index = None if index is None else int(index)
+  except Exception:
+    return {"error": "invalid index"}, 400
+  return lane.skip(index)
+
+@app.route("/startlist/move", methods=['POST'])
+def move_startlist(request):
+  # {"from": i, "to": j} verschiebt einen Eintrag der Startliste
+  lane = find_lane(request.args.get("lane"))
+  if lane is None:
+    return UNKNOWN_LANE
+  try:
+    payload = request.json
+    src = int(payload.get("from"))
+    dst = int(payload.get("to"))
+  except Exception:
+    return {"error": "from and to required"}, 400
+  return lane.move(src, dst)
+
+async def wait_for_change(since, wait_ms):
+  stream = changes.subscribe()
+  try:
+    if since == state_version:
+      await asyncio.wait_for(stream.__anext__(), wait_ms / 1000)
+  except asyncio.TimeoutError:
+    pass
+  finally:
+    await stream.aclose()
 
 @app.route("/current")
-def get_current(request):
-  global start_ts_us, finish_ts_us, state, sensor_enabled, manual_active, current_participant
-  elapsed = None
-  if start_ts_us and finish_ts_us:
-    elapsed = elapsed_ms_from_us(start_ts_us, finish_ts_us)
-  elif start_ts_us and state == "running":
-    elapsed = elapsed_ms_from_us(start_ts_us, micros_now())
-  resp = {
-    "state": state,
-    "sensor_active": sensor_enabled,
-    "manual_active": manual_active,
-    "participant": current_participant,
-    "start": ms_from_us(start_ts_us) if start_ts_us else 0,
-    "finish": ms_from_us(finish_ts_us) if finish_ts_us else 0,
-    "elapsed": elapsed
-  }
-  return ujson.dumps(resp)
+async def get_current(request):
+  # ?lane=<nr> wählt die Bahn (ohne Angabe die erste)
+  # ?since=<version>&wait=<ms>: antwortet erst bei einer neueren Version
+  q = request.args
+  lane = find_lane(q.get("lane"))
+  if lane is None:
+    return UNKNOWN_LANE
+  if "since" in q:
+    try:
+      since = int(q.get("since"))
+      wait_ms = min(int(q.get("wait", LONG_POLL_MAX_MS)), LONG_POLL_MAX_MS)
+    except Exception:
+      return {"error": "invalid since/wait"}, 400
+    if wait_ms > 0:
+      await wait_for_change(since, wait_ms)
+  if lane.state == "running":
+    return lane.current_body()
+  etag = '"%d"' % state_version
+  if request.headers.get("If-None-Match") == etag:
+    return "", 304, {"ETag": etag}
+  return lane.current_body(), {"ETag": etag}
+
+def lanes_status():
+  return {"lanes": [lanes[lane[0]].status() for lane in LANES]}
+
+@app.route("/lanes")
+def get_lanes(request):
+  return lanes_status()
 
 @app.route("/results")
 def get_results(request):
@@ -414,59 +936,142 @@ def get_results(request):
       limit = int(q.get("limit"))
     except Exception:
       limit = None
-  results = load_all_results(limit=limit)
-  return ujson.dumps({"count": len(results), "results": results})
+  return Response(stream_results(limit=limit))
+
+@app.route("/results/<int:seq>")
+def get_result(request, seq):
+  for result in iter_results(seq, 1):
+    return result
+  return {"error": "no result"}, 404
+
+@app.route("/results/download")
+def download_results(request):
+  # JSONL-Export, mit ?from=<seq> ab einem Ergebnis fortsetzen;
+  # ?format=bin liefert die Binärdatei, mit Range fortsetzbar
+  q = request.args
+  if not count_results():
+    return {"error": "no results"}, 404
+  if q.get("format") == "bin":
+    res = Response.send_file(RESULTS_FILE, content_type="application/octet-stream", request=request)
+    filename = RESULTS_FILE
+  else:
+    try:
+      first = int(q.get("from", 0))
+    except ValueError:
+      return {"error": "invalid from"}, 400
+    res = Response(export_results(first), headers={"Content-Type": "application/x-ndjson"})
+    filename = LEGACY_RESULTS_FILE
+  res.headers["Content-Disposition"] = 'attachment; filename="%s"' % filename
+  return res
+
+def reset_lane(lane):
+  lane.reset()
+  return {"status": "reset", "lane": lane.number}
 
 @app.route("/reset", methods=['POST'])
 def reset(request):
-  reset_run()
-  return ujson.dumps({"status": "reset"})
+  lane = find_lane(request.args.get("lane"))
+  if lane is None:
+    return UNKNOWN_LANE
+  return reset_lane(lane)
 
 @app.route("/sensor/on", methods=['POST'])
 def sensor_on(request):
-  global sensor_enabled
-  sensor_enabled = True
-  return ujson.dumps({"sensor_enabled": True})
+  lane = find_lane(request.args.get("lane"))
+  if lane is None:
+    return UNKNOWN_LANE
+  return lane.set_sensor(True)
 
 @app.route("/sensor/off", methods=['POST'])
 def sensor_off(request):
-  global sensor_enabled
-  sensor_enabled = False
-  return ujson.dumps({"sensor_enabled": False})
+  lane = find_lane(request.args.get("lane"))
+  if lane is None:
+    return UNKNOWN_LANE
+  return lane.set_sensor(False)
 
-@app.route("/manual/start", methods=['POST'])
+@app.route("/manual/start", methods=['POST'], critical=True)
 def manual_start(request):
-  global state, start_ts_us, manual_active, current_participant
-  if state == "running":
-    return ujson.dumps({"error": "already running"})
-  now = micros_now()
-  start_ts_us = now
-  state = "running"
-  manual_active = True
-  return ujson.dumps({"status": "manual_start", "start_ms": ms_from_us(start_ts_us), "participant": current_participant})
-
-@app.route("/manual/stop", methods=['POST'])
+  lane = find_lane(request.args.get("lane"))
+  if lane is None:
+    return UNKNOWN_LANE
+  return lane.start_manual()
+
+@app.route("/manual/stop", methods=['POST'], critical=True)
 def manual_stop(request):
-  global state, finish_ts_us, manual_active, start_ts_us, current_participant
-  if state != "running":
-    return ujson.dumps({"error": "no active run"})
-  now = micros_now()
-  if time.ticks_diff(now, start_ts_us)//1000 < MIN_ELAPSED_MS:
-    return ujson.dumps({"error": "min_elapsed_not_reached"})
-  finish_ts_us = now
-  result = make_result_payload(start_ts_us, finish_ts_us, current_participant)
-  save_result(result)
-  elapsed = elapsed_ms_from_us(start_ts_us, finish_ts_us)
-  state = "idle"
-  manual_active = False
-  current_participant = None
-  return ujson.dumps({"status":"manual_stop", "finish_ms": ms_from_us(finish_ts_us), "elapsed_ms": elapsed, "result": result})
+  lane = find_lane(request.args.get("lane"))
+  if lane is None:
+    return UNKNOWN_LANE
+  return lane.stop_manual()
+
+@app.route("/events")
+def get_events(request):
+  # Server-Sent Events statt Polling von /current
+  return events.response()
+
+def run_command(message):
+  # Steuerbefehle über /ws, z.B. {"cmd": "start", "lane": 2} oder
+  # {"cmd": "participant", "dog_name": "Rex"}; ohne lane die erste Bahn
+  try:
+    command = ujson.loads(message)
+    cmd = command.get("cmd")
+  except Exception:
+    return {"error": "invalid json"}
+  if cmd == "lanes":
+    return lanes_status()
+  lane = find_lane(command.get("lane"))
+  if lane is None:
+    return UNKNOWN_LANE[0]
+  if cmd == "start":
+    return lane.start_manual()
+  if cmd == "stop":
+    return lane.stop_manual()
+  if cmd == "reset":
+    return reset_lane(lane)
+  if cmd == "participant":
+    return participant_error(command) or lane.set_participant(command)
+  if cmd == "sensor":
+    return lane.set_sensor(bool(command.get("enabled")))
+  if cmd == "current":
+    return lane.status()
+  return {"error": "unknown command"}
+
+async def push_events(ws, stream):
+  async for message in stream:
+    await ws.send(message)
+
+@app.route("/ws")
+@with_websocket
+async def websocket(request, ws):
+  # Bidirektionale Steuerung: Befehle empfangen, Ereignisse pushen
+  stream = ws_events.subscribe()
+  pusher = asyncio.create_task(push_events(ws, stream))
+  try:
+    await ws.send(ujson.dumps({"event": "current", "data": find_lane().status()}))
+    while True:
+      message = await ws.receive()
+      await ws.send(ujson.dumps({"event": "reply", "data": run_command(message)}))
+  finally:
+    pusher.cancel()
+    await stream.aclose()
 
 @app.route("/simple-status")
 def simple_status(request):
-  return ujson.dumps({"status": "ok"})
+  return {"status": "ok"}
+
+# Anfragezähler und Laufzeit-Histogramme unter /metrics (?format=json)
+METRICS_ENABLED = True
+if METRICS_ENABLED:
+  Metrics(app)
+
+async def main():
+  # Webserver, Trigger-Verarbeitung und MQTT teilen sich eine Event-Loop
+  asyncio.create_task(process_triggers())
+  if MQTTHandler is not None:
+    mqtt = MQTTHandler()
+    asyncio.create_task(mqtt.loop())
+  await app.start_server(host='0.0.0.0', port=80)
 
 if __name__ == '__main__':
   print("Starte Webserver und API auf 0.0.0.0:80 ...")
-  app.run(host='0.0.0.0', port=80)
+  asyncio.run(main())
     
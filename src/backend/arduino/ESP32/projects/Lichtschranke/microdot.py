@@ -6,6 +6,8 @@ The ``microdot`` module defines a few classes that help implement HTTP-based
 servers for MicroPython and standard Python, with multithreading support for
 Python interpreters that support it.
 """
+import gc
+
 try:
     from sys import print_exception
 except ImportError:  # pragma: no cover
@@ -26,12 +28,24 @@ try:  # pragma: no cover
     def create_thread(f, *args, **kwargs):
         # use the threading module
         threading.Thread(target=f, args=args, kwargs=kwargs).start()
+
+    allocate_lock = threading.Lock
 except ImportError:  # pragma: no cover
-    def create_thread(f, *args, **kwargs):
-        # no threads available, call function synchronously
-        f(*args, **kwargs)
+    try:
+        import _thread
 
-    concurrency_mode = 'sync'
+        def create_thread(f, *args, **kwargs):
+            # use the low-level thread module of MicroPython
+            _thread.start_new_thread(f, args, kwargs)
+
+        allocate_lock = _thread.allocate_lock
+    except ImportError:
+        def create_thread(f, *args, **kwargs):
+            # no threads available, call function synchronously
+            f(*args, **kwargs)
+
+        allocate_lock = None
+        concurrency_mode = 'sync'
 
 try:
     import ujson as json
@@ -43,6 +57,30 @@ try:
 except ImportError:
     import re
 
+try:
+    memoryview('')
+except TypeError:
+    def _encode_str(s):
+        return s.encode()
+else:  # pragma: no cover
+    def _encode_str(s):
+        # MicroPython strings are stored in UTF-8 and expose their bytes as a
+        # buffer, so they can be sent without making an encoded copy
+        return memoryview(s)
+
+try:
+    import uos as os
+except ImportError:
+    import os
+
+try:
+    from select import poll, POLLIN
+except ImportError:  # pragma: no cover
+    try:
+        from uselect import poll, POLLIN
+    except ImportError:
+        poll = None
+
 socket_timeout_error = OSError
 try:
     import usocket as socket
@@ -275,6 +313,421 @@ class MultiDict(dict):
         return values
 
 
+class RequestHeaders():
+    """The headers of a request, with case-insensitive keys.
+
+    :param raw: The bytes of the request head.
+    :param start: The offset in ``raw`` of the line break that ends the request
+                  line.
+    :param end: The offset in ``raw`` where the headers end.
+
+    The headers are kept in their raw form, and a header is only decoded when
+    it is accessed. Headers can be accessed with the same interface as a
+    :class:`NoCaseDict <microdot.NoCaseDict>`.
+    """
+    __slots__ = ('_raw', '_start', '_end', '_lower', '_values', '_names')
+
+    def __init__(self, raw=b'', start=0, end=0):
+        self._raw = raw
+        self._start = start
+        self._end = end
+        self._lower = None
+        self._values = {}
+        self._names = {}
+
+    def _lookup(self, kl):
+        # return the decoded value of a header given its lowercase name, or
+        # None if the header is not in the request
+        if kl in self._values:
+            return self._values[kl]
+        value = None
+        if self._end > self._start:
+            if self._lower is None:
+                self._lower = self._raw.lower()
+            key = kl.encode()
+            pos = self._lower.rfind(key, self._start, self._end)
+            while pos > self._start:
+                end = pos + len(key)
+                if self._lower[pos - 1] == 10 and end < self._end and \
+                        self._lower[end] == 58:  # "\n{key}:"
+                    line_end = self._raw.find(b'\r\n', end, self._end)
+                    if line_end < 0:
+                        line_end = self._end
+                    value = self._raw[end + 1:line_end].decode().strip()
+                    break
+                pos = self._lower.rfind(key, self._start, pos)
+        self._values[kl] = value
+        return value
+
+    def __getitem__(self, key):
+        value = self._lookup(key.lower())
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        kl = key.lower()
+        self._values[kl] = value
+        self._names[kl] = key
+
+    def __delitem__(self, key):
+        kl = key.lower()
+        if self._lookup(kl) is None:
+            raise KeyError(key)
+        self._values[kl] = None
+
+    def __contains__(self, key):
+        return self._lookup(key.lower()) is not None
+
+    def get(self, key, default=None):
+        value = self._lookup(key.lower())
+        return default if value is None else value
+
+    def update(self, other_dict):
+        for key, value in other_dict.items():
+            self[key] = value
+
+    def items(self):
+        items = []
+        seen = []
+        if self._end > self._start:
+            for line in self._raw[self._start + 1:self._end].split(b'\r\n'):
+                name = line.split(b':', 1)[0].strip().decode()
+                kl = name.lower()
+                if kl not in seen:
+                    seen.append(kl)
+                    value = self._lookup(kl)
+                    if value is not None:
+                        items.append((self._names.get(kl, name), value))
+        for kl, value in self._values.items():
+            if kl not in seen and value is not None:
+                items.append((self._names.get(kl, kl), value))
+        return items
+
+    def keys(self):
+        return [key for key, value in self.items()]
+
+    def values(self):
+        return [value for key, value in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+    def __repr__(self):  # pragma: no cover
+        return repr(dict(self.items()))
+
+
+class ResponseHeaders():
+    """The headers of a response, with case-insensitive keys.
+
+    :param initial_dict: an initial dictionary of key/value pairs to
+                         initialize this object with.
+
+    The names and values are stored in a single list, in the order in which
+    they were added, which needs less memory than a dictionary for the few
+    headers of a response. Headers can be accessed with the same interface as
+    a :class:`NoCaseDict <microdot.NoCaseDict>`.
+    """
+    __slots__ = ('_items',)
+
+    def __init__(self, initial_dict=None):
+        self._items = []
+        if initial_dict:
+            for key, value in initial_dict.items():
+                self[key] = value
+
+    def _index(self, key):
+        # return the position of the name of a header in the list, or -1;
+        # names are usually given with the same case in which they were
+        # added, so a case-insensitive comparison is only done as a fallback
+        items = self._items
+        for i in range(0, len(items), 2):
+            if items[i] == key:
+                return i
+        kl = None
+        for i in range(0, len(items), 2):
+            if len(items[i]) == len(key):
+                if kl is None:
+                    kl = key.lower()
+                if items[i].lower() == kl:
+                    return i
+        return -1
+
+    def __getitem__(self, key):
+        i = self._index(key)
+        if i < 0:
+            raise KeyError(key)
+        return self._items[i + 1]
+
+    def __setitem__(self, key, value):
+        i = self._index(key)
+        if i < 0:
+            self._items.append(key)
+            self._items.append(value)
+        else:
+            self._items[i + 1] = value
+
+    def __delitem__(self, key):
+        i = self._index(key)
+        if i < 0:
+            raise KeyError(key)
+        del self._items[i:i + 2]
+
+    def __contains__(self, key):
+        return self._index(key) >= 0
+
+    def get(self, key, default=None):
+        i = self._index(key)
+        return default if i < 0 else self._items[i + 1]
+
+    def update(self, other_dict):
+        for key, value in other_dict.items():
+            self[key] = value
+
+    def clear(self):
+        self._items.clear()
+
+    def items(self):
+        items = self._items
+        for i in range(0, len(items), 2):
+            yield items[i], items[i + 1]
+
+    def keys(self):
+        return self._items[::2]
+
+    def values(self):
+        return self._items[1::2]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._items) // 2
+
+    def __repr__(self):  # pragma: no cover
+        return repr(dict(self.items()))
+
+
+class ConnectionReader():
+    """A buffered reader for the data sent by a client on a connection.
+
+    :param stream: The socket or file-like object of the connection.
+    :param size: The size of the buffer. The request line and the headers of
+                 a request must fit in it. The default is given by
+                 :attr:`Request.max_head_length`.
+
+    The reader uses a single buffer for all the requests that are received on
+    the connection. Data received after the headers of a request, such as the
+    first part of the body, stays in the buffer until it is read through
+    :meth:`read`, :meth:`readinto` or :meth:`readline`.
+    """
+    __slots__ = ('stream', 'buf', 'mv', 'start', 'end', 'clock', 'received',
+                 'timeout', '_read_once', '_readinto', '_poller', '_timeout_ms')
+
+    def __init__(self, stream, size=None):
+        self.buf = bytearray(size or Request.max_head_length)
+        self.mv = memoryview(self.buf)
+        #: A function that returns the current time in ticks, used to record
+        #: in :attr:`received` when the data of each request starts to arrive.
+        self.clock = None
+        self._poller = None
+        self.reset(stream)
+
+    def reset(self, stream):
+        """Prepare the reader for a new connection, keeping its buffer.
+
+        :param stream: The socket or file-like object of the connection, or
+                       ``None`` to only release the previous one.
+        """
+        self.stream = stream
+        self.start = 0
+        self.end = 0
+        self.received = 0
+        #: The timeout of the stream in seconds, as set by :meth:`settimeout`.
+        self.timeout = None
+        self._timeout_ms = -1
+        self._read_once = None
+        self._readinto = None
+        self._poller = None
+        if stream is None:
+            return
+        if hasattr(stream, 'recv_into'):
+            self._read_once = stream.recv_into
+        elif hasattr(stream, 'readinto') and hasattr(stream, 'setblocking') \
+                and poll is not None:  # pragma: no cover
+            # MicroPython sockets
+            self._poller = poll()
+            self._poller.register(stream, POLLIN)
+            self._read_once = self._poll_readinto
+        elif hasattr(stream, 'recv'):  # pragma: no cover
+            self._read_once = self._recv
+        elif hasattr(stream, 'readinto1'):
+            self._read_once = stream.readinto1
+        else:  # pragma: no cover
+            self._read_once = self._readline
+        # reads of a known length do not need to stop at a partial read
+        self._readinto = getattr(stream, 'readinto', self._read_once)
+
+    def settimeout(self, timeout):
+        """Set the timeout in seconds for reading from and writing to the
+        stream, or ``None`` to block.
+        """
+        self.timeout = timeout
+        self._timeout_ms = -1 if timeout is None else int(timeout * 1000)
+        self.stream.settimeout(timeout)
+
+    def _poll_readinto(self, buf):  # pragma: no cover
+        # MicroPython sockets have no recv_into, and their readinto only
+        # returns a partial read when the socket does not block. Wait for
+        # data with the timeout of the socket, then read what has arrived
+        # straight into the buffer without blocking
+        while True:
+            for _ in self._poller.ipoll(self._timeout_ms):
+                break
+            else:
+                raise OSError(errno.ETIMEDOUT)
+            self.stream.setblocking(False)
+            try:
+                n = self.stream.readinto(buf)
+            finally:
+                self.stream.settimeout(self.timeout)
+            if n is not None:
+                return n
+
+    def _recv(self, buf):
+        # last resort, allocates a bytes object for every read
+        data = self.stream.recv(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def _readline(self, buf):  # pragma: no cover
+        # streams that cannot do a single partial read are read by lines, so
+        # that the reader never waits for data that the client did not send
+        data = self.stream.readline(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def _make_room(self):
+        # move the unread data to the start of the buffer
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start:
+            data = bytes(self.mv[self.start:self.end])
+            self.end -= self.start
+            self.start = 0
+            self.buf[:self.end] = data
+        if self.end == len(self.buf):
+            raise ValueError('request too large')
+
+    def _fill(self):
+        self._make_room()
+        n = self._read_once(self.mv[self.end:])
+        if n:
+            self.end += n
+        return n
+
+    def _find_head(self, scanned=0):
+        # look for the end of the request head in the buffer, skipping the
+        # first ``scanned`` bytes that were searched before except for the
+        # last three, which could hold the start of the separator. Return a
+        # copy of the head with the end offset of the headers, or None
+        start = self.start
+        end = self.buf.find(b'\r\n\r\n', start + max(scanned - 3, 0),
+                            self.end)
+        if end < 0:
+            return None
+        # copy only the head, not the pipelined data that follows it
+        self.start = end + 4
+        return bytes(self.mv[start:end + 4]), end - start
+
+    def _find_line(self, size, scanned):
+        # look for the end of a line in the buffer, skipping the first
+        # ``scanned`` bytes that were searched before, and return a copy of
+        # the line, or None
+        available = self.end - self.start
+        pos = self.buf.find(b'\n', self.start + scanned, self.end)
+        if pos >= 0:
+            n = pos + 1 - self.start
+        elif size >= 0 and available >= size:
+            n = size
+        else:
+            return None
+        if size >= 0:
+            n = min(n, size)
+        self.start += n
+        return bytes(self.mv[self.start - n:self.start])
+
+    def read_head(self):
+        """Read the request line and the headers of the next request.
+
+        This method returns a tuple with a bytes object that contains the
+        request head and the offset where the headers end in it, or ``None``
+        if the client closed the connection.
+        """
+        if self.end == self.start and not self._fill():
+            return None
+        if self.clock:
+            self.received = self.clock()
+        head = self._find_head()
+        while head is None:
+            # the unread data can move to the start of the buffer when it is
+            # filled, so the searched part is counted from the unread data
+            scanned = self.end - self.start
+            if not self._fill():
+                return None
+            head = self._find_head(scanned)
+        return head
+
+    def readinto(self, buf):
+        """Read data into a buffer, returning the number of bytes read."""
+        if self.start == self.end:
+            return self._readinto(buf)
+        n = min(len(buf), self.end - self.start)
+        buf[:n] = self.mv[self.start:self.start + n]
+        self.start += n
+        return n
+
+    def readinto_exactly(self, buf):
+        """Fill a buffer with data, raising ``EOFError`` if the stream ends
+        before the buffer is full."""
+        mv = memoryview(buf)
+        i = 0
+        while i < len(buf):
+            n = self.readinto(mv[i:])
+            if not n:
+                raise EOFError()
+            i += n
+
+    def read(self, n=-1):
+        """Read up to ``n`` bytes, or until the end of the stream when ``n``
+        is negative."""
+        if n < 0:
+            chunks = []
+            while True:
+                data = self.read(len(self.buf))
+                if not data:
+                    return b''.join(chunks)
+                chunks.append(data)
+        buf = bytearray(n)
+        n = self.readinto(buf)
+        return bytes(buf[:n])
+
+    def readline(self, size=-1):
+        """Read a line, up to ``size`` bytes."""
+        line = self._find_line(size, 0)
+        while line is None:
+            scanned = self.end - self.start
+            if not self._fill():
+                line = bytes(self.mv[self.start:self.end])
+                self.start = self.end
+                break
+            line = self._find_line(size, scanned)
+        return line
+
+
 class Request():
     """An HTTP request."""
     #: Specify the maximum payload size that is accepted. Requests with larger
@@ -297,14 +750,18 @@ class Request():
     #:    Request.max_body_length = 4 * 1024  # up to 4KB bodies read
     max_body_length = 16 * 1024
 
-    #: Specify the maximum length allowed for a line in the request. Requests
-    #: with longer lines will not be correctly interpreted. Applications can
-    #: change this maximum as necessary.
+    #: Deprecated, this limit is not used anymore. The request line and the
+    #: headers are limited together by :attr:`max_head_length`.
+    max_readline = 2 * 1024
+
+    #: Specify the maximum length allowed for the request line and the
+    #: headers together. Each connection reads requests through a buffer of
+    #: this size. Requests with a longer head are rejected.
     #:
     #: Example::
     #:
-    #:    Request.max_readline = 16 * 1024  # 16KB lines allowed
-    max_readline = 2 * 1024
+    #:    Request.max_head_length = 4 * 1024  # 4KB request heads allowed
+    max_head_length = 2 * 1024
 
     #: Specify a suggested read timeout to use when reading the request. Set to
     #: 0 to disable the use of a timeout. This timeout should be considered a
@@ -315,8 +772,14 @@ class Request():
     class G:
         pass
 
+    __slots__ = ('app', 'client_addr', 'method', 'url', 'path', 'query_string',
+                 'headers', 'route_index', 'http_version', 'url_args', '_g',
+                 '_args', '_cookies', '_content_length', '_content_type',
+                 '_body', 'body_used', '_stream', 'stream_used', 'sock',
+                 '_json', '_form', 'after_request_handlers')
+
     def __init__(self, app, client_addr, method, url, http_version, headers,
-                 body=None, stream=None, sock=None):
+                 body=None, stream=None, sock=None, content_length=None):
         #: The application instance to which this request belongs.
         self.app = app
         #: The address of the client, as a tuple (host, port).
@@ -329,35 +792,23 @@ class Request():
         self.path = url
         #: The query string portion of the URL.
         self.query_string = None
-        #: The parsed query string, as a
-        #: :class:`MultiDict <microdot.MultiDict>` object.
-        self.args = {}
         #: A dictionary with the headers included in the request.
         self.headers = headers
-        #: A dictionary with the cookies included in the request.
-        self.cookies = {}
-        #: The parsed ``Content-Length`` header.
-        self.content_length = 0
-        #: The parsed ``Content-Type`` header.
-        self.content_type = None
-        #: A general purpose container for applications to store data during
-        #: the life of the request.
-        self.g = Request.G()
+        #: The index in the URL map of the application of the route that
+        #: handles the request, or ``None`` if no route matched.
+        self.route_index = None
 
         self.http_version = http_version
         if '?' in self.path:
             self.path, self.query_string = self.path.split('?', 1)
-            self.args = self._parse_urlencoded(self.query_string)
-
-        if 'Content-Length' in self.headers:
-            self.content_length = int(self.headers['Content-Length'])
-        if 'Content-Type' in self.headers:
-            self.content_type = self.headers['Content-Type']
-        if 'Cookie' in self.headers:
-            for cookie in self.headers['Cookie'].split(';'):
-                name, value = cookie.strip().split('=', 1)
-                self.cookies[name] = value
 
+        # the query string, the cookies and the content headers are parsed
+        # the first time they are used, unless the server already parsed
+        # the content length to read the body
+        self._args = None
+        self._cookies = None
+        self._content_length = content_length
+        self._content_type = None
         self._body = body
         self.body_used = False
         self._stream = stream
@@ -365,7 +816,22 @@ class Request():
         self.sock = sock
         self._json = None
         self._form = None
-        self.after_request_handlers = []
+        self._g = None
+        self.url_args = None
+        # replaced with a list when a handler is registered
+        self.after_request_handlers = ()
+
+    @classmethod
+    def _get(cls, pool, app, client_addr, method, url, http_version, headers,
+             body=None, stream=None, sock=None, content_length=None):
+        # create a request, or reinitialize one taken from the pool
+        req = pool.get() if pool else None
+        if req is None:
+            return cls(app, client_addr, method, url, http_version, headers,
+                       body, stream, sock, content_length)
+        req.__init__(app, client_addr, method, url, http_version, headers,
+                     body, stream, sock, content_length)
+        return req
 
     @staticmethod
     def create(app, client_stream, client_addr, client_sock=None):
@@ -374,31 +840,45 @@ class Request():
 
         :param app: The Microdot application instance.
         :param client_stream: An input stream from where the request data can
-                              be read.
+                              be read, or a
+                              :class:`ConnectionReader <microdot.ConnectionReader>`
+                              that wraps it.
         :param client_addr: The address of the client, as a tuple.
         :param client_sock: The low-level socket associated with the request.
 
         This method returns a newly created ``Request`` object.
         """
-        # request line
-        line = Request._safe_readline(client_stream).strip().decode()
-        if not line:
+        if not isinstance(client_stream, ConnectionReader):
+            client_stream = ConnectionReader(client_stream)
+        head = client_stream.read_head()
+        if head is None:
             return None
-        method, url, http_version = line.split()
-        http_version = http_version.split('/', 1)[1]
+        method, url, http_version, headers = Request._parse_head(*head)
+        return Request._get(getattr(app, '_requests', None), app, client_addr,
+                            method, url, http_version, headers,
+                            stream=client_stream, sock=client_sock)
 
-        # headers
-        headers = NoCaseDict()
-        while True:
-            line = Request._safe_readline(client_stream).strip().decode()
-            if line == '':
-                break
-            header, value = line.split(':', 1)
-            value = value.strip()
-            headers[header] = value
-
-        return Request(app, client_addr, method, url, http_version, headers,
-                       stream=client_stream, sock=client_sock)
+    @staticmethod
+    def _parse_head(head, end):
+        # parse the request line in place, and leave the headers in their
+        # raw form to be decoded on access
+        line_end = head.find(b'\r\n', 0, end)
+        if line_end < 0:
+            line_end = end
+        sp1 = head.find(b' ', 0, line_end)
+        sp2 = head.find(b' ', sp1 + 1, line_end)
+        if sp1 <= 0 or sp2 < 0 or not head.startswith(b'HTTP/', sp2 + 1):
+            raise ValueError('invalid request line')
+        method = head[:sp1].decode()
+        url = head[sp1 + 1:sp2].decode()
+        if head.startswith(b'1.1', sp2 + 6):
+            http_version = '1.1'
+        elif head.startswith(b'1.0', sp2 + 6):
+            http_version = '1.0'
+        else:  # pragma: no cover
+            http_version = head[sp2 + 6:line_end].decode()
+        return method, url, http_version, RequestHeaders(
+            head, line_end + 1, end)
 
     def _parse_urlencoded(self, urlencoded):
         data = MultiDict()
@@ -415,23 +895,74 @@ class Request():
                         if len(kv) > 1 else b''
         return data
 
+    @property
+    def g(self):
+        """A general purpose container for applications to store data during
+        the life of the request."""
+        if self._g is None:
+            self._g = Request.G()
+        return self._g
+
+    @property
+    def args(self):
+        """The parsed query string, as a
+        :class:`MultiDict <microdot.MultiDict>` object."""
+        if self._args is None:
+            self._args = self._parse_urlencoded(self.query_string) \
+                if self.query_string is not None else {}
+        return self._args
+
+    @property
+    def cookies(self):
+        """A dictionary with the cookies included in the request."""
+        if self._cookies is None:
+            self._cookies = {}
+            cookies = self.headers.get('Cookie')
+            if cookies:
+                for cookie in cookies.split(';'):
+                    # a malformed cookie must not fail the handler that
+                    # reads the cookies, so pieces without a value are
+                    # skipped
+                    cookie = cookie.strip()
+                    if '=' not in cookie:
+                        continue
+                    name, value = cookie.split('=', 1)
+                    self._cookies[name] = value
+        return self._cookies
+
+    @property
+    def content_length(self):
+        """The parsed ``Content-Length`` header."""
+        if self._content_length is None:
+            self._content_length = int(self.headers.get('Content-Length', 0))
+        return self._content_length
+
+    @property
+    def content_type(self):
+        """The parsed ``Content-Type`` header."""
+        if self._content_type is None:
+            self._content_type = self.headers.get('Content-Type')
+        return self._content_type
+
     @property
     def body(self):
-        """The body of the request, as bytes."""
+        """The body of the request, as a ``memoryview`` of the buffer in which
+        it was received. The buffer is allocated once, with the size given
+        in the ``Content-Length`` header."""
         if self.stream_used:
             raise RuntimeError('Cannot use both stream and body')
         if self._body is None:
             self._body = b''
             if self.content_length and \
                     self.content_length <= Request.max_body_length:
-                while len(self._body) < self.content_length:
-                    data = self._stream.read(
-                        self.content_length - len(self._body))
-                    if len(data) == 0:  # pragma: no cover
-                        raise EOFError()
-                    self._body += data
+                self._body = bytearray(self.content_length)
+                if isinstance(self._stream, ConnectionReader):
+                    self._stream.readinto_exactly(self._body)
+                else:  # pragma: no cover
+                    ConnectionReader.readinto_exactly(self._stream,
+                                                      self._body)
                 self.body_used = True
-        return self._body
+        return memoryview(self._body)
 
     @property
     def stream(self):
@@ -451,7 +982,8 @@ class Request():
             mime_type = self.content_type.split(';')[0]
             if mime_type != 'application/json':
                 return None
-            self._json = json.loads(self.body.decode())
+            self.body
+            self._json = json.loads(self._body)
         return self._json
 
     @property
@@ -465,9 +997,23 @@ class Request():
             mime_type = self.content_type.split(';')[0]
             if mime_type != 'application/x-www-form-urlencoded':
                 return None
-            self._form = self._parse_urlencoded(self.body)
+            self._form = self._parse_urlencoded(bytes(self.body))
         return self._form
 
+    def _skip_body(self):
+        # make sure that no part of the request body is left in the stream,
+        # so that the connection can be used for another request
+        if self.stream_used or self.content_length > self.max_content_length:
+            return False
+        if not self.body_used and self.content_length:
+            if self.content_length > Request.max_body_length:
+                return False
+            try:
+                self.body
+            except Exception:
+                return False
+        return True
+
     def after_request(self, f):
         """Register a request-specific function to run after the request is
         handled. Request-specific after request handlers run at the very end,
@@ -490,16 +1036,11 @@ class Request():
         Note that the function is not called if the request handler raises an
         exception and an error response is returned instead.
         """
+        if not self.after_request_handlers:
+            self.after_request_handlers = []
         self.after_request_handlers.append(f)
         return f
 
-    @staticmethod
-    def _safe_readline(stream):
-        line = stream.readline(Request.max_readline + 1)
-        if len(line) > Request.max_readline:
-            raise ValueError('line too long')
-        return line
-
 
 class Response():
     """An HTTP response class.
@@ -515,6 +1056,10 @@ class Response():
     :param reason: A custom reason phrase to add after the status code. The
                    default is "OK" for responses with a 200 status code and
                    "N/A" for any other status codes.
+
+    On MicroPython the body of a response given as a string, a dictionary or
+    a list is a ``memoryview`` of the string, which avoids an encoded copy of
+    the body.
     """
     types_map = {
         'css': 'text/css',
@@ -528,6 +1073,40 @@ class Response():
     }
     send_file_buffer_size = 1024
 
+    #: The size of the buffer in which the items of a generator body are
+    #: merged when the response uses chunked transfer encoding, so that small
+    #: items are not sent as individual chunks. The default is close to the
+    #: payload of a TCP segment on Ethernet and WiFi networks. Items that do
+    #: not fit in the buffer are sent as chunks of their own.
+    chunk_buffer_size = 1460
+
+    #: The size of the buffer in which the status line and the headers of a
+    #: response are assembled. Bodies that fit in the remaining space are sent
+    #: in the same write as the headers. The servers allocate one buffer per
+    #: connection and reuse it for all the responses sent on it.
+    write_buffer_size = 512
+
+    #: Pre-encoded header lines for common header values. Headers that are
+    #: not in this map are encoded when the response is written.
+    encoded_headers = {
+        'Content-Type': {
+            'application/json': b'Content-Type: application/json\r\n',
+            'application/json; charset=UTF-8':
+                b'Content-Type: application/json; charset=UTF-8\r\n',
+            'text/html; charset=UTF-8':
+                b'Content-Type: text/html; charset=UTF-8\r\n',
+            'text/plain; charset=UTF-8':
+                b'Content-Type: text/plain; charset=UTF-8\r\n',
+        },
+        'Connection': {
+            'keep-alive': b'Connection: keep-alive\r\n',
+            'close': b'Connection: close\r\n',
+        },
+    }
+
+    # encoded status lines for the status codes used with the default reason
+    _status_lines = {}
+
     #: The content type to use for responses that do not explicitly define a
     #: ``Content-Type`` header.
     default_content_type = 'text/plain'
@@ -540,23 +1119,45 @@ class Response():
     #: written to the client. Used to exit WebSocket connections cleanly.
     already_handled = None
 
+    __slots__ = ('status_code', 'headers', 'reason', 'body', 'is_head',
+                 '_pooled')
+
     def __init__(self, body='', status_code=200, headers=None, reason=None):
+        self.headers = ResponseHeaders()
+        self._pooled = False
+        self._setup(body, status_code, headers, reason)
+
+    def _setup(self, body, status_code, headers, reason):
         if body is None and status_code == 200:
             body = ''
             status_code = 204
         self.status_code = status_code
-        self.headers = NoCaseDict(headers or {})
+        if headers:
+            self.headers.update(headers)
         self.reason = reason
         if isinstance(body, (dict, list)):
-            self.body = json.dumps(body).encode()
+            self.body = _encode_str(json.dumps(body))
             self.headers['Content-Type'] = 'application/json; charset=UTF-8'
         elif isinstance(body, str):
-            self.body = body.encode()
+            self.body = _encode_str(body)
         else:
             # this applies to bytes, file-like objects or generators
             self.body = body
         self.is_head = False
 
+    @classmethod
+    def _get(cls, pool, body='', status_code=200, headers=None, reason=None):
+        # create a response, or reinitialize one taken from the pool; only
+        # the responses created here are returned to the pool after use
+        res = pool.get() if pool else None
+        if res is None:
+            res = cls(body, status_code, headers, reason)
+            res._pooled = pool is not None
+        else:
+            res.headers.clear()
+            res._setup(body, status_code, headers, reason)
+        return res
+
     def set_cookie(self, cookie, value, path=None, domain=None, expires=None,
                    max_age=None, secure=False, http_only=False):
         """Add a cookie to the response.
@@ -594,7 +1195,7 @@ class Response():
             self.headers['Set-Cookie'] = [http_cookie]
 
     def complete(self):
-        if isinstance(self.body, bytes) and \
+        if isinstance(self.body, (bytes, memoryview)) and \
                 'Content-Length' not in self.headers:
             self.headers['Content-Length'] = str(len(self.body))
         if 'Content-Type' not in self.headers:
@@ -602,28 +1203,79 @@ class Response():
             if 'charset=' not in self.headers['Content-Type']:
                 self.headers['Content-Type'] += '; charset=UTF-8'
 
-    def write(self, stream):
+    def _serialize(self, buf=None):
+        # assemble the status line, the headers and, if it fits, the body of
+        # the response in buf, which is grown only when the headers do not
+        # fit in it; returns the buffer, the length of the data and a flag
+        # that indicates if the body was included
         self.complete()
+        if buf is None:
+            buf = bytearray(self.write_buffer_size)
 
         # status code
-        reason = self.reason if self.reason is not None else \
-            ('OK' if self.status_code == 200 else 'N/A')
-        stream.write('HTTP/1.0 {status_code} {reason}\r\n'.format(
-            status_code=self.status_code, reason=reason).encode())
+        if self.reason is None:
+            line = self._status_lines.get(self.status_code)
+            if line is None:
+                line = 'HTTP/1.1 {status_code} {reason}\r\n'.format(
+                    status_code=self.status_code,
+                    reason='OK' if self.status_code == 200 else 'N/A').encode()
+                self._status_lines[self.status_code] = line
+        else:
+            line = 'HTTP/1.1 {status_code} {reason}\r\n'.format(
+                status_code=self.status_code, reason=self.reason).encode()
+        n = len(line)
+        buf[:n] = line
 
         # headers
         for header, value in self.headers.items():
             values = value if isinstance(value, list) else [value]
             for value in values:
-                stream.write('{header}: {value}\r\n'.format(
-                    header=header, value=value).encode())
-        stream.write(b'\r\n')
+                line = self.encoded_headers.get(header, {}).get(value)
+                if line is None:
+                    line = '{header}: {value}\r\n'.format(
+                        header=header, value=value).encode()
+                end = n + len(line) + 2
+                if end > len(buf):  # pragma: no cover
+                    buf = buf[:n] + bytearray(end + self.write_buffer_size)
+                buf[n:end - 2] = line
+                n = end - 2
+        buf[n:n + 2] = b'\r\n'
+        n += 2
+
+        # body
+        body_included = self.is_head
+        if not body_included and isinstance(self.body, (bytes, memoryview)) \
+                and n + len(self.body) <= len(buf):
+            buf[n:n + len(self.body)] = self.body
+            n += len(self.body)
+            body_included = True
+        return buf, n, body_included
+
+    def write(self, stream, buf=None, sock=None):
+        buf, n, body_included = self._serialize(buf)
+        stream.write(memoryview(buf)[:n])
 
         # body
-        if not self.is_head:
+        if not body_included:
+            if sock is not None and hasattr(sock, 'sendfile') and \
+                    hasattr(self.body, 'fileno') and \
+                    'Content-Length' in self.headers:  # pragma: no cover
+                # let the kernel copy the file to the socket
+                if hasattr(stream, 'flush'):
+                    stream.flush()
+                try:
+                    sock.sendfile(self.body, self.body.tell(),
+                                  int(self.headers['Content-Length']))
+                finally:
+                    self.body.close()
+                return
+            if self.headers.get('Transfer-Encoding') == 'chunked':
+                body_iter = self._chunked_iter(self.body_iter(), buf)
+            else:
+                body_iter = self.body_iter(buf)
             can_flush = hasattr(stream, 'flush')
             try:
-                for body in self.body_iter():
+                for body in body_iter:
                     if isinstance(body, str):  # pragma: no cover
                         body = body.encode()
                     stream.write(body)
@@ -635,22 +1287,107 @@ class Response():
                 else:
                     raise
 
-    def body_iter(self):
+    def body_iter(self, buf=None):
         if self.body:
             if hasattr(self.body, 'read'):
-                while True:
-                    buf = self.body.read(self.send_file_buffer_size)
-                    if len(buf):
-                        yield buf
-                    if len(buf) < self.send_file_buffer_size:
-                        break
-                if hasattr(self.body, 'close'):  # pragma: no cover
-                    self.body.close()
+                yield from self._file_chunks(buf)
             elif hasattr(self.body, '__next__'):
                 yield from self.body
             else:
                 yield self.body
 
+    def _file_chunks(self, buf=None):
+        # read a file body in chunks of send_file_buffer_size bytes, all
+        # returned as views of the same buffer, which is only valid until the
+        # next chunk is requested; the buffer of the connection is used when
+        # it is large enough. A Content-Length header limits the bytes that
+        # are read, which is how byte ranges are sent.
+        size = self.send_file_buffer_size
+        if buf is None or len(buf) < size:
+            buf = bytearray(size)
+        mv = memoryview(buf)
+        readinto = getattr(self.body, 'readinto', None)
+        remaining = int(self.headers.get('Content-Length', -1))
+        try:
+            while remaining:
+                n = size if remaining < 0 else min(size, remaining)
+                if readinto:
+                    n = readinto(mv[:n])
+                    chunk = mv[:n]
+                else:  # pragma: no cover
+                    chunk = self.body.read(n)
+                    n = len(chunk)
+                if not n:
+                    break
+                if remaining > 0:
+                    remaining -= n
+                yield chunk
+        finally:
+            if hasattr(self.body, 'close'):  # pragma: no cover
+                self.body.close()
+
+    def _chunked_iter(self, items, buf=None):
+        # merge the items of a body into chunks of the chunked transfer
+        # encoding, assembled in a buffer that is reused for all of them, as
+        # in _file_chunks(); the chunk size is written with leading zeros in
+        # the space reserved for it before the data
+        size = self.chunk_buffer_size
+        if buf is None or len(buf) < size:
+            buf = bytearray(size)
+        mv = memoryview(buf)
+        end = len(buf) - 2
+        n = 6
+        for data in items:
+            if isinstance(data, str):
+                data = data.encode()
+            if n + len(data) > end and n > 6:
+                yield self._end_chunk(buf, n)
+                n = 6
+            if 6 + len(data) > end:
+                yield self._encode_chunk(data)
+            elif data:
+                mv[n:n + len(data)] = data
+                n += len(data)
+        if n > 6:
+            yield self._end_chunk(buf, n)
+        yield b'0\r\n\r\n'
+
+    @staticmethod
+    def _end_chunk(buf, n):
+        buf[:6] = '{:04x}\r\n'.format(n - 6).encode()
+        buf[n:n + 2] = b'\r\n'
+        return memoryview(buf)[:n + 2]
+
+    @staticmethod
+    def _encode_chunk(data):
+        return '{:x}\r\n'.format(len(data)).encode() + data + b'\r\n'
+
+    @staticmethod
+    def _parse_range(value, size):
+        # parse the value of a Range header for a file of the given size, and
+        # return the positions of the first and last byte requested, or None
+        # when the header should be ignored (multiple ranges or bad syntax,
+        # which includes negative values and a last byte before the first)
+        if not value.startswith('bytes=') or ',' in value:
+            return None
+        first, last = (value[6:].strip().split('-', 1) + [''])[:2]
+        if (first and not first.isdigit()) or (last and not last.isdigit()) \
+                or not (first or last):
+            return None
+        if first:
+            first = int(first)
+            if not last:
+                last = size - 1
+            elif int(last) < first:
+                return None
+            else:
+                last = int(last)
+        else:
+            first = max(size - int(last), 0)
+            last = size - 1
+        # a first byte at or beyond the end of the file is answered with 416
+        return first, min(last, size - 1)
+
     @classmethod
     def redirect(cls, location, status_code=302):
         """Return a redirect response.
@@ -666,7 +1403,7 @@ class Response():
     @classmethod
     def send_file(cls, filename, status_code=200, content_type=None,
                   stream=None, max_age=None, compressed=False,
-                  file_extension=''):
+                  file_extension='', request=None):
         """Send file contents in a response.
 
         :param filename: The filename of the file.
@@ -693,6 +1430,17 @@ class Response():
                                parameter when opening the file, including the
                                dot. The extension given here is not considered
                                when generating the ``Content-Type`` header.
+        :param request: The request that is being answered. If given, a
+                        ``304`` response without a body is returned when the
+                        ``If-None-Match`` header of the request matches the
+                        ``ETag`` of the file, and a ``Range`` header is
+                        answered with a ``206`` response that contains the
+                        requested bytes, unless an ``If-Range`` header with a
+                        different ``ETag`` is also given.
+
+        When the file is opened by name, the ``Content-Length`` and ``ETag``
+        headers are generated from the size and modification time of the
+        file.
 
         Security note: The filename is assumed to be trusted. Never pass
         filenames provided by the user without validating and sanitizing them
@@ -715,15 +1463,104 @@ class Response():
             headers['Content-Encoding'] = compressed \
                 if isinstance(compressed, str) else 'gzip'
 
+        first = 0
+        if stream is None:
+            st = os.stat(filename + file_extension)
+            size = st[6]
+            etag = '"{:x}-{:x}"'.format(int(st[8]), size)
+            headers['Content-Length'] = str(size)
+            headers['ETag'] = etag
+            headers['Accept-Ranges'] = 'bytes'
+            if request is not None:
+                if etag in request.headers.get('If-None-Match', ''):
+                    return cls(body=b'', status_code=304, headers=headers)
+                byte_range = request.headers.get('Range')
+                if byte_range and status_code == 200 and \
+                        request.headers.get('If-Range', etag) == etag:
+                    byte_range = cls._parse_range(byte_range, size)
+                if isinstance(byte_range, tuple):
+                    first, last = byte_range
+                    if first > last:
+                        headers['Content-Range'] = 'bytes */{}'.format(size)
+                        headers['Content-Length'] = '0'
+                        return cls(body=b'', status_code=416,
+                                   headers=headers)
+                    headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                        first, last, size)
+                    headers['Content-Length'] = str(last - first + 1)
+                    status_code = 206
         f = stream or open(filename + file_extension, 'rb')
+        if first:
+            f.seek(first)
         return cls(body=f, status_code=status_code, headers=headers)
 
 
+class _WorkQueue:
+    # A bounded queue of accepted connections for the worker threads, built
+    # only on locks so that it also works with the _thread module. The ready
+    # lock is held while the queue is empty, which blocks the workers. It is
+    # only ever released while holding the mutex and only when it is locked,
+    # since a worker can take it between a put and its own mutex section.
+    def __init__(self, size):
+        self.size = size
+        self.items = []
+        self.mutex = allocate_lock()
+        self.ready = allocate_lock()
+        self.ready.acquire()
+
+    def put(self, item, force=False):
+        with self.mutex:
+            if len(self.items) >= self.size and not force:
+                return False
+            self.items.append(item)
+            if self.ready.locked():
+                self.ready.release()
+        return True
+
+    def get(self):
+        while True:
+            self.ready.acquire()
+            with self.mutex:
+                if self.items:
+                    item = self.items.pop(0)
+                    if self.items and self.ready.locked():
+                        # wake up the next worker
+                        self.ready.release()
+                    return item
+
+
+class _Pool:
+    # a bounded free list of objects that are reused instead of being
+    # allocated again; appending to and popping from a list are atomic, so
+    # the worker threads can share a pool without a lock
+    def __init__(self, size):
+        self.size = size
+        self.items = []
+
+    def get(self):
+        if self.items:
+            try:
+                return self.items.pop()
+            except IndexError:  # pragma: no cover
+                pass
+        return None
+
+    def put(self, item):
+        if len(self.items) < self.size:
+            self.items.append(item)
+
+
 class URLPattern():
     def __init__(self, url_pattern):
         self.url_pattern = url_pattern
         self.pattern = ''
         self.args = []
+        #: The path segments of the pattern. Static segments are given as
+        #: strings, dynamic segments as ``(type, name)`` tuples.
+        self.segments = []
+        #: ``False`` if the pattern has segments that can only be matched with
+        #: a regular expression (``path`` and ``re:`` types).
+        self.indexable = True
         use_regex = False
         for segment in url_pattern.lstrip('/').split('/'):
             if segment and segment[0] == '<':
@@ -745,11 +1582,15 @@ class URLPattern():
                     pattern = type_[3:]
                 else:
                     raise ValueError('invalid URL segment type')
+                if type_ not in ('string', 'int'):
+                    self.indexable = False
                 use_regex = True
                 self.pattern += '/({pattern})'.format(pattern=pattern)
                 self.args.append({'type': type_, 'name': name})
+                self.segments.append((type_, name))
             else:
                 self.pattern += '/{segment}'.format(segment=segment)
+                self.segments.append(segment)
         if use_regex:
             self.pattern = re.compile('^' + self.pattern + '$')
 
@@ -772,6 +1613,82 @@ class URLPattern():
         return args
 
 
+def _is_int(segment):
+    if segment[:1] == '-':
+        segment = segment[1:]
+    return segment.isdigit()
+
+
+class _RouteIndex():
+    # A compiled version of the application's URL map. Static paths are
+    # looked up in a dictionary, and dynamic paths with ``string`` and ``int``
+    # components in a trie of path segments, so the cost of a lookup depends
+    # on the depth of the path and not on the number of routes. Patterns that
+    # need a regular expression are matched one by one as before.
+    #
+    # A trie node is a list with a dictionary of static child segments, a
+    # dictionary of dynamic child nodes by segment type, and the routes that
+    # end at the node. Each route is stored with its position in the URL map,
+    # so that the first matching route wins as in a linear scan.
+    def __init__(self, url_map):
+        self.static = {}
+        self.root = [{}, {}, []]
+        self.fallback = []
+        for index, (methods, pattern, handler) in enumerate(url_map):
+            route = (index, set(methods), handler, pattern)
+            if isinstance(pattern.pattern, str):
+                self.static.setdefault(pattern.pattern, []).append(route)
+            elif pattern.indexable:
+                node = self.root
+                for segment in pattern.segments:
+                    if isinstance(segment, str):
+                        children = node[0]
+                    else:
+                        children = node[1]
+                        segment = segment[0]
+                    if segment not in children:
+                        children[segment] = [{}, {}, []]
+                    node = children[segment]
+                node[2].append(route)
+            else:
+                self.fallback.append(route)
+
+    def match(self, path):
+        # return the routes that match the given path, as a list of
+        # (index, methods, handler, url_args) tuples
+        matches = [(index, methods, handler, {})
+                   for index, methods, handler, _ in self.static.get(path, ())]
+        if path[:1] == '/' and (self.root[0] or self.root[1]):
+            self._match_node(self.root, path[1:].split('/'), 0, [], matches)
+        for index, methods, handler, pattern in self.fallback:
+            args = pattern.match(path)
+            if args is not None:
+                matches.append((index, methods, handler, args))
+        return matches
+
+    def _match_node(self, node, segments, i, values, matches):
+        if i == len(segments):
+            for index, methods, handler, pattern in node[2]:
+                args = {}
+                for arg, value in zip(pattern.args, values):
+                    args[arg['name']] = value
+                matches.append((index, methods, handler, args))
+            return
+        segment = segments[i]
+        child = node[0].get(segment)
+        if child:
+            self._match_node(child, segments, i + 1, values, matches)
+        if segment:
+            child = node[1].get('string')
+            if child:
+                self._match_node(child, segments, i + 1, values + [segment],
+                                 matches)
+            child = node[1].get('int')
+            if child and _is_int(segment):
+                self._match_node(child, segments, i + 1,
+                                 values + [int(segment)], matches)
+
+
 class HTTPException(Exception):
     def __init__(self, status_code, reason=None):
         self.status_code = status_code
@@ -795,6 +1712,64 @@ class Microdot():
         app = Microdot()
     """
 
+    #: The number of seconds an idle persistent connection is kept open while
+    #: waiting for the next request. Set to 0 to close the connection after
+    #: each response.
+    #:
+    #: Example::
+    #:
+    #:    app.keep_alive_timeout = 10
+    keep_alive_timeout = 5
+
+    #: The maximum number of requests that are served on a single persistent
+    #: connection. The response to the last request closes the connection.
+    max_keep_alive_requests = 100
+
+    #: The number of worker threads that handle connections when the server
+    #: runs in threaded mode. Accepted connections wait in a queue until a
+    #: worker is available.
+    max_workers = 2
+
+    #: The number of accepted connections that can wait for a worker. When
+    #: the queue is full, new connections get a ``503`` response with a
+    #: ``Retry-After`` header and are closed.
+    max_queued_connections = 8
+
+    #: The number of seconds sent in the ``Retry-After`` header of the
+    #: responses to connections that cannot be queued.
+    retry_after = 1
+
+    #: The backlog of the listening socket, which is the number of incoming
+    #: connections that the operating system queues until they are accepted.
+    listen_backlog = 5
+
+    #: The number of connection buffers, request objects and response objects
+    #: that are kept after use, so that the following connections and
+    #: requests reuse them instead of allocating new ones. This reduces the
+    #: garbage produced by each request, and with it the number of garbage
+    #: collection pauses. Applications that enable pooling must not use a
+    #: request or response object after the response was sent. Only the
+    #: responses that the application creates from the values returned by
+    #: the handlers are reused. Set to 0 to disable pooling.
+    #:
+    #: Example::
+    #:
+    #:    app.pool_size = 2
+    pool_size = 0
+
+    #: The amount of free heap memory, in bytes, below which requests are
+    #: not dispatched. When the free memory is below this watermark a
+    #: garbage collection is done, and if that does not free enough memory
+    #: the request gets a ``503`` response with a ``Retry-After`` header,
+    #: unless its route was registered with ``critical=True``. The free
+    #: memory is obtained from ``gc.mem_free()``, so the check is only done
+    #: on MicroPython. Set to 0 to disable the check.
+    #:
+    #: Example::
+    #:
+    #:    app.min_free_memory = 16 * 1024
+    min_free_memory = 0
+
     def __init__(self):
         self.url_map = []
         self.before_request_handlers = []
@@ -805,8 +1780,18 @@ class Microdot():
         self.options_handler = self.default_options_handler
         self.debug = False
         self.server = None
-
-    def route(self, url_pattern, methods=None):
+        #: The :class:`Metrics <microdot_metrics.Metrics>` instance that
+        #: records the requests, or ``None``.
+        self.metrics = None
+        self._route_index = None
+        self._critical_routes = set()
+        self._queue = None
+        self._busy_response = None
+        self._connections = None
+        self._requests = None
+        self._responses = None
+
+    def route(self, url_pattern, methods=None, critical=False):
         """Decorator that is used to register a function as a request handler
         for a given URL.
 
@@ -815,6 +1800,9 @@ class Microdot():
         :param methods: The list of HTTP methods to be handled by the
                         decorated function. If omitted, only ``GET`` requests
                         are handled.
+        :param critical: If ``True``, requests for this route are dispatched
+                         even when the free memory is below
+                         :attr:`min_free_memory`.
 
         The URL pattern can be a static path (for example, ``/users`` or
         ``/api/invoices/search``) or a path with dynamic components enclosed
@@ -837,9 +1825,12 @@ class Microdot():
                 return 'Hello, world!'
         """
         def decorated(f):
+            if critical:
+                self._critical_routes.add(len(self.url_map))
             self.url_map.append(
                 ([m.upper() for m in (methods or ['GET'])],
                  URLPattern(url_pattern), f))
+            self._route_index = None
             return f
         return decorated
 
@@ -1013,10 +2004,13 @@ class Microdot():
         :param subapp: The sub-application to mount.
         :param url_prefix: The URL prefix to mount the application under.
         """
-        for methods, pattern, handler in subapp.url_map:
+        for i, (methods, pattern, handler) in enumerate(subapp.url_map):
+            if i in subapp._critical_routes:
+                self._critical_routes.add(len(self.url_map))
             self.url_map.append(
                 (methods, URLPattern(url_prefix + pattern.url_pattern),
                  handler))
+        self._route_index = None
         for handler in subapp.before_request_handlers:
             self.before_request_handlers.append(handler)
         for handler in subapp.after_request_handlers:
@@ -1091,11 +2085,16 @@ class Microdot():
                 mode=concurrency_mode, host=host, port=port))
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.bind(addr)
-        self.server.listen(5)
+        self.server.listen(self.listen_backlog)
 
         if ssl:
             self.server = ssl.wrap_socket(self.server, server_side=True)
 
+        if concurrency_mode == 'threaded':  # pragma: no branch
+            self._queue = _WorkQueue(self.max_queued_connections)
+            for _ in range(self.max_workers):
+                create_thread(self._worker, self._queue)
+
         while not self.shutdown_requested:
             try:
                 sock, addr = self.server.accept()
@@ -1107,7 +2106,112 @@ class Microdot():
             except Exception as exc:  # pragma: no cover
                 print_exception(exc)
             else:
-                create_thread(self.handle_request, sock, addr)
+                if self._queue is None:  # pragma: no cover
+                    self.handle_request(sock, addr)
+                elif not self._queue.put((sock, addr)):
+                    self._reject(sock)
+
+        if self._queue is not None:  # pragma: no branch
+            for _ in range(self.max_workers):
+                self._queue.put(None, force=True)
+            self._queue = None
+
+    def _worker(self, queue):
+        # nothing replaces a worker that ends, so only the stop marker may
+        # end the loop
+        while True:
+            try:
+                item = queue.get()
+                if item is None:
+                    break
+                self.handle_request(*item)
+            except Exception as exc:  # pragma: no cover
+                print_exception(exc)
+
+    def _open_connection(self, reader_class, stream):
+        # return the reader and the write buffer for a new connection, taken
+        # from the pool when pooling is enabled
+        if self.pool_size and self._connections is None:
+            self._connections = _Pool(self.pool_size)
+            self._requests = _Pool(self.pool_size)
+            self._responses = _Pool(self.pool_size)
+        conn = self._connections.get() if self._connections else None
+        if conn is None:
+            return [reader_class(stream),
+                    bytearray(Response.write_buffer_size)]
+        conn[0].reset(stream)
+        return conn
+
+    def _close_connection(self, conn):
+        if self._connections:
+            conn[0].reset(None)
+            self._connections.put(conn)
+
+    def _release(self, req, res):
+        # return the objects of a request that was answered to their pools,
+        # without the references to the data of the request
+        if self._requests is None:
+            return
+        if req is not None:
+            req.headers = req._body = req._stream = req.sock = None
+            req._json = req._form = req._g = None
+            req.after_request_handlers = ()
+            self._requests.put(req)
+        if res is not None and res._pooled:
+            res.body = None
+            self._responses.put(res)
+
+    def _low_memory(self, req):
+        # check the free memory before a request is dispatched, and return
+        # True if the request has to be rejected; critical routes are never
+        # rejected and never delayed by a collection
+        if not self.min_free_memory or not hasattr(gc, 'mem_free') or \
+                req.route_index in self._critical_routes:
+            return False
+        if gc.mem_free() >= self.min_free_memory:
+            return False
+        gc.collect()
+        if gc.mem_free() >= self.min_free_memory:
+            return False
+        if self.metrics:
+            self.metrics.shed += 1
+        return True
+
+    def _out_of_memory(self):
+        # a handler raised MemoryError; release what it left behind and ask
+        # the client to try again
+        gc.collect()
+        if self.metrics:
+            self.metrics.shed += 1
+        return self._unavailable()
+
+    def _unavailable(self):
+        return 'Service unavailable', 503, {
+            'Retry-After': str(self.retry_after)}
+
+    def _reject(self, sock):
+        # answer a connection that cannot be queued without reading its
+        # request, so that the accept loop is not blocked
+        if self.metrics:  # pragma: no cover
+            self.metrics.rejected += 1
+        try:
+            sock.setblocking(False)
+            try:
+                sock.recv(Request.max_head_length)
+            except OSError:
+                pass
+            sock.send(self._busy_response or self._encode_busy_response())
+        except OSError:  # pragma: no cover
+            pass
+        sock.close()
+
+    def _encode_busy_response(self):
+        self._busy_response = (
+            'HTTP/1.1 503 Service Unavailable\r\n'
+            'Retry-After: {}\r\n'
+            'Content-Length: 0\r\n'
+            'Connection: close\r\n\r\n').format(self.retry_after).encode()
+        return self._busy_response
 
     def shutdown(self):
         """Request a server shutdown. The server will then exit its request
@@ -1124,6 +2228,11 @@ class Microdot():
         """
         self.shutdown_requested = True
 
+    def _match_routes(self, path):
+        if self._route_index is None:
+            self._route_index = _RouteIndex(self.url_map)
+        return self._route_index.match(path)
+
     def find_route(self, req):
         method = req.method.upper()
         if method == 'OPTIONS' and self.options_handler:
@@ -1131,64 +2240,138 @@ class Microdot():
         if method == 'HEAD':
             method = 'GET'
         f = 404
-        for route_methods, route_pattern, route_handler in self.url_map:
-            req.url_args = route_pattern.match(req.path)
-            if req.url_args is not None:
-                if method in route_methods:
-                    f = route_handler
-                    break
-                else:
-                    f = 405
+        req.url_args = None
+        first = None
+        for index, methods, handler, url_args in self._match_routes(req.path):
+            if method in methods:
+                if first is None or index < first:
+                    first = index
+                    f = handler
+                    req.url_args = url_args
+            elif first is None:
+                f = 405
+        req.route_index = first
         return f
 
     def default_options_handler(self, req):
         allow = []
-        for route_methods, route_pattern, route_handler in self.url_map:
-            if route_pattern.match(req.path) is not None:
-                allow.extend(route_methods)
+        for route in sorted(self._match_routes(req.path),
+                            key=lambda route: route[0]):
+            allow.extend(self.url_map[route[0]][0])
         if 'GET' in allow:
             allow.append('HEAD')
         allow.append('OPTIONS')
         return {'Allow': ', '.join(allow)}
 
     def handle_request(self, sock, addr):
-        if Request.socket_read_timeout and \
-                hasattr(sock, 'settimeout'):  # pragma: no cover
-            sock.settimeout(Request.socket_read_timeout)
+        can_timeout = hasattr(sock, 'settimeout')
         if not hasattr(sock, 'readline'):  # pragma: no cover
             stream = sock.makefile("rwb")
         else:
             stream = sock
 
-        req = None
-        res = None
-        try:
-            req = Request.create(self, stream, addr, sock)
-            res = self.dispatch_request(req)
-        except socket_timeout_error as exc:  # pragma: no cover
-            if exc.errno and exc.errno != errno.ETIMEDOUT:
-                print_exception(exc)  # not a timeout
-        except Exception as exc:  # pragma: no cover
-            print_exception(exc)
+        conn = self._open_connection(ConnectionReader, sock)
+        reader, buf = conn
+        metrics = self.metrics
+        if metrics:
+            reader.clock = metrics.ticks
+        served = 0
+        keep_alive = True
+        while keep_alive:
+            req = None
+            res = None
+            keep_alive = False
+            try:
+                if served and can_timeout:  # pragma: no cover
+                    reader.settimeout(self.keep_alive_timeout)
+                elif Request.socket_read_timeout and \
+                        can_timeout:  # pragma: no cover
+                    reader.settimeout(Request.socket_read_timeout)
+                req = Request.create(self, reader, addr, sock)
+                if req is None and served:
+                    break  # the client closed the persistent connection
+                if metrics:
+                    parsed = metrics.ticks()
+                if served and Request.socket_read_timeout and \
+                        can_timeout:  # pragma: no cover
+                    reader.settimeout(Request.socket_read_timeout)
+                res = self.dispatch_request(req)
+                if metrics:
+                    dispatched = metrics.ticks()
+            except socket_timeout_error as exc:  # pragma: no cover
+                if exc.errno and exc.errno != errno.ETIMEDOUT:
+                    print_exception(exc)  # not a timeout
+            except Exception as exc:  # pragma: no cover
+                print_exception(exc)
+            served += 1
+            try:
+                if res and res != Response.already_handled:  # pragma: no branch
+                    keep_alive = self._keep_alive(req, res, served)
+                    res.write(stream, buf, sock)
+                    if keep_alive and hasattr(stream, 'flush'):
+                        stream.flush()
+                    if metrics and req:
+                        metrics.record(req, res, reader.received, parsed,
+                                       dispatched)
+            except OSError as exc:  # pragma: no cover
+                keep_alive = False
+                if exc.errno in MUTED_SOCKET_ERRORS:
+                    pass
+                else:
+                    print_exception(exc)
+            except Exception as exc:  # pragma: no cover
+                keep_alive = False
+                print_exception(exc)
+            if self.debug and req:  # pragma: no cover
+                print('{method} {path} {status_code}'.format(
+                    method=req.method, path=req.path,
+                    status_code=res.status_code))
+            if self.shutdown_requested:  # pragma: no cover
+                keep_alive = False
+            self._release(req, res)
+        self._close_connection(conn)
         try:
-            if res and res != Response.already_handled:  # pragma: no branch
-                res.write(stream)
             stream.close()
         except OSError as exc:  # pragma: no cover
             if exc.errno in MUTED_SOCKET_ERRORS:
                 pass
             else:
                 print_exception(exc)
-        except Exception as exc:  # pragma: no cover
-            print_exception(exc)
         if stream != sock:  # pragma: no cover
             sock.close()
         if self.shutdown_requested:  # pragma: no cover
             self.server.close()
-        if self.debug and req:  # pragma: no cover
-            print('{method} {path} {status_code}'.format(
-                method=req.method, path=req.path,
-                status_code=res.status_code))
+
+    def _keep_alive(self, req, res, served):
+        # decide if the connection can be used for another request after
+        # this response, and add the corresponding Connection header; HTTP/1.1
+        # responses with a generator body and no length use chunked transfer
+        # encoding, which marks the end of the body. Connections are not kept
+        # open while other connections are waiting for a worker thread.
+        if req and req.http_version == '1.1' and \
+                'Content-Length' not in res.headers and \
+                not hasattr(res.body, 'read') and \
+                (hasattr(res.body, '__next__') or
+                 hasattr(res.body, '__anext__')):
+            res.headers['Transfer-Encoding'] = 'chunked'
+        keep_alive = False
+        if req and self.keep_alive_timeout and \
+                served < self.max_keep_alive_requests and \
+                not (self._queue and self._queue.items):
+            connection = req.headers.get('Connection', '').lower()
+            if req.http_version == '1.0':
+                keep_alive = connection == 'keep-alive'
+            else:
+                keep_alive = connection != 'close'
+            if keep_alive:
+                # the end of the response must be known to the client and
+                # the request body must be fully read from the stream
+                res.complete()
+                keep_alive = ('Content-Length' in res.headers or
+                              'Transfer-Encoding' in res.headers) and \
+                    req._skip_body()
+        res.headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        return keep_alive
 
     def dispatch_request(self, req):
         after_request_handled = False
@@ -1200,6 +2383,8 @@ class Microdot():
                     res = 'Payload too large', 413
             else:
                 f = self.find_route(req)
+                if callable(f) and self._low_memory(req):
+                    f = 503
                 try:
                     res = None
                     if callable(f):
@@ -1217,18 +2402,21 @@ class Microdot():
                             else:
                                 status_code = 200
                                 headers = res[1]
-                            res = Response(body, status_code, headers)
+                            res = Response._get(self._responses, body,
+                                                status_code, headers)
                         elif not isinstance(res, Response):
-                            res = Response(res)
+                            res = Response._get(self._responses, res)
                         for handler in self.after_request_handlers:
                             res = handler(req, res) or res
                         for handler in req.after_request_handlers:
                             res = handler(req, res) or res
                         after_request_handled = True
                     elif isinstance(f, dict):
-                        res = Response(headers=f)
+                        res = Response._get(self._responses, headers=f)
                     elif f in self.error_handlers:
                         res = self.error_handlers[f](req)
+                    elif f == 503:
+                        res = self._unavailable()
                     else:
                         res = 'Not found', f
                 except HTTPException as exc:
@@ -1252,6 +2440,8 @@ class Microdot():
                             res = self.error_handlers[exc_class](req, exc)
                         except Exception as exc2:  # pragma: no cover
                             print_exception(exc2)
+                    if res is None and isinstance(exc, MemoryError):
+                        res = self._out_of_memory()
                     if res is None:
                         if 500 in self.error_handlers:
                             res = self.error_handlers[500](req)
@@ -1264,9 +2454,9 @@ class Microdot():
                 res = 'Bad request', 400
 
         if isinstance(res, tuple):
-            res = Response(*res)
+            res = Response._get(self._responses, *res)
         elif not isinstance(res, Response):
-            res = Response(res)
+            res = Response._get(self._responses, res)
         if not after_request_handled:
             for handler in self.after_error_request_handlers:
                 res = handler(req, res) or res
@@ -0,0 +1,594 @@
+"""
+microdot_asyncio
+----------------
+
+The ``microdot_asyncio`` module defines a few classes that help implement
+HTTP-based servers for MicroPython and standard Python that use ``asyncio``
+and coroutines.
+"""
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    import uio as io
+except ImportError:
+    import io
+
+from microdot import ConnectionReader as BaseConnectionReader
+from microdot import Microdot as BaseMicrodot
+from microdot import mro
+from microdot import Request as BaseRequest
+from microdot import Response as BaseResponse
+from microdot import print_exception
+from microdot import HTTPException
+from microdot import MUTED_SOCKET_ERRORS
+
+
+def _iscoroutine(coro):
+    return hasattr(coro, 'send') and hasattr(coro, 'throw')
+
+
+class _AsyncBytesIO:
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    async def read(self, n=-1):
+        return self.stream.read(n)
+
+    async def readline(self):  # pragma: no cover
+        return self.stream.readline()
+
+    async def readexactly(self, n):  # pragma: no cover
+        return self.stream.read(n)
+
+    async def awrite(self, data):  # pragma: no cover
+        return self.stream.write(data)
+
+    async def aclose(self):  # pragma: no cover
+        pass
+
+
+class ConnectionReader(BaseConnectionReader):
+    """A buffered reader for the data sent by a client on a connection, that
+    reads from an ``asyncio`` stream. The methods that read data are
+    coroutines.
+    """
+    __slots__ = ()
+
+    def reset(self, stream):
+        super().reset(stream)
+        if stream is not None:
+            self._read_once = self._stream_read_once
+
+    async def _stream_read_once(self, buf):
+        if hasattr(self.stream, 'readinto'):
+            return await self.stream.readinto(buf) or 0
+        data = await self.stream.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    async def _fill(self):
+        self._make_room()
+        n = await self._read_once(self.mv[self.end:])
+        if n:
+            self.end += n
+        return n
+
+    async def read_head(self):
+        if self.end == self.start and not await self._fill():
+            return None
+        if self.clock:
+            self.received = self.clock()
+        head = self._find_head()
+        while head is None:
+            scanned = self.end - self.start
+            if not await self._fill():
+                return None
+            head = self._find_head(scanned)
+        return head
+
+    async def readinto(self, buf):
+        if self.start == self.end:
+            return await self._read_once(buf)
+        n = min(len(buf), self.end - self.start)
+        buf[:n] = self.mv[self.start:self.start + n]
+        self.start += n
+        return n
+
+    async def read(self, n=-1):
+        if n < 0:
+            chunks = []
+            while True:
+                data = await self.read(len(self.buf))
+                if not data:
+                    return b''.join(chunks)
+                chunks.append(data)
+        buf = bytearray(n)
+        n = await self.readinto(buf)
+        return bytes(buf[:n])
+
+    async def readinto_exactly(self, buf):
+        mv = memoryview(buf)
+        i = 0
+        while i < len(buf):
+            n = await self.readinto(mv[i:])
+            if not n:
+                raise EOFError()
+            i += n
+
+    async def readexactly(self, n):
+        buf = bytearray(n)
+        await self.readinto_exactly(buf)
+        return bytes(buf)
+
+    async def readline(self, size=-1):
+        line = self._find_line(size, 0)
+        while line is None:
+            scanned = self.end - self.start
+            if not await self._fill():
+                line = bytes(self.mv[self.start:self.end])
+                self.start = self.end
+                break
+            line = self._find_line(size, scanned)
+        return line
+
+
+class Request(BaseRequest):
+    __slots__ = ()
+
+    @staticmethod
+    async def create(app, client_reader, client_writer, client_addr):
+        """Create a request object.
+
+        :param app: The Microdot application instance.
+        :param client_reader: An input stream from where the request data can
+                              be read, or a
+                              :class:`ConnectionReader` that wraps it.
+        :param client_writer: An output stream where the response data can be
+                              written.
+        :param client_addr: The address of the client, as a tuple.
+
+        This method is a coroutine. It returns a newly created ``Request``
+        object.
+        """
+        if not isinstance(client_reader, ConnectionReader):
+            client_reader = ConnectionReader(client_reader)
+        head = await client_reader.read_head()
+        if head is None:
+            return None
+        method, url, http_version, headers = Request._parse_head(*head)
+        content_length = int(headers.get('Content-Length', 0))
+
+        # body
+        body = b''
+        if content_length and content_length <= Request.max_body_length:
+            body = bytearray(content_length)
+            await client_reader.readinto_exactly(body)
+            stream = None
+        else:
+            body = b''
+            stream = client_reader
+
+        return Request._get(getattr(app, '_requests', None), app, client_addr,
+                            method, url, http_version, headers, body=body,
+                            stream=stream, sock=(client_reader, client_writer),
+                            content_length=content_length)
+
+    @property
+    def stream(self):
+        if self._stream is None:
+            self._stream = _AsyncBytesIO(self._body)
+        return self._stream
+
+    def _skip_body(self):
+        # the body is read when the request is created, unless it is too
+        # large and the application is expected to read it from the stream
+        return self.content_length <= Request.max_body_length and \
+            self.content_length <= self.max_content_length
+
+
+class Response(BaseResponse):
+    """An HTTP response class.
+
+    :param body: The body of the response. If a dictionary or list is given,
+                 a JSON formatter is used to generate the body. If a file-like
+                 object or an async generator is given, a streaming response is
+                 used. If a string is given, it is encoded from UTF-8. Else,
+                 the body should be a byte sequence.
+    :param status_code: The numeric HTTP status code of the response. The
+                        default is 200.
+    :param headers: A dictionary of headers to include in the response.
+    :param reason: A custom reason phrase to add after the status code. The
+                   default is "OK" for responses with a 200 status code and
+                   "N/A" for any other status codes.
+    """
+    __slots__ = ()
+
+    async def write(self, stream, buf=None):
+        buf, n, body_included = self._serialize(buf)
+
+        try:
+            await stream.awrite(memoryview(buf)[:n])
+
+            # body
+            if not body_included and hasattr(self.body, 'readinto'):
+                # files are read through the buffer of the connection
+                for chunk in self._file_chunks(buf):
+                    await stream.awrite(chunk)
+            elif not body_included and \
+                    self.headers.get('Transfer-Encoding') == 'chunked':
+                if hasattr(self.body, '__anext__'):
+                    # items of async bodies are sent as soon as they arrive
+                    async for body in self.body:
+                        if isinstance(body, str):
+                            body = body.encode()
+                        if body:
+                            await stream.awrite(self._encode_chunk(body))
+                    await stream.awrite(b'0\r\n\r\n')
+                else:
+                    for chunk in self._chunked_iter(self.body, buf):
+                        await stream.awrite(chunk)
+            elif not body_included:
+                async for body in self.body_iter():
+                    if isinstance(body, str):  # pragma: no cover
+                        body = body.encode()
+                    await stream.awrite(body)
+        except OSError as exc:  # pragma: no cover
+            if exc.errno in MUTED_SOCKET_ERRORS or \
+                    exc.args[0] == 'Connection lost':
+                pass
+            else:
+                raise
+        finally:
+            if hasattr(self.body, 'aclose'):
+                # let streaming bodies release their resources
+                await self.body.aclose()
+
+    def body_iter(self):
+        if hasattr(self.body, '__anext__'):
+            # response body is an async generator
+            return self.body
+
+        response = self
+
+        class iter:
+            def __aiter__(self):
+                if response.body:
+                    self.i = 0  # need to determine type of response.body
+                else:
+                    self.i = -1  # no response body
+                return self
+
+            async def __anext__(self):
+                if self.i == -1:
+                    raise StopAsyncIteration
+                if self.i == 0:
+                    if hasattr(response.body, 'read'):
+                        self.i = 2  # response body is a file-like object
+                    elif hasattr(response.body, '__next__'):
+                        self.i = 1  # response body is a sync generator
+                        return next(response.body)
+                    else:
+                        self.i = -1  # response body is a plain string
+                        return response.body
+                elif self.i == 1:
+                    try:
+                        return next(response.body)
+                    except StopIteration:
+                        raise StopAsyncIteration
+                buf = response.body.read(response.send_file_buffer_size)
+                if _iscoroutine(buf):  # pragma: no cover
+                    buf = await buf
+                if len(buf) < response.send_file_buffer_size:
+                    self.i = -1
+                    if hasattr(response.body, 'close'):  # pragma: no cover
+                        result = response.body.close()
+                        if _iscoroutine(result):
+                            await result
+                return buf
+
+        return iter()
+
+
+class Microdot(BaseMicrodot):
+    """An HTTP application class that runs on ``asyncio``.
+
+    Route handlers, before and after request handlers and error handlers can
+    be regular functions or coroutines. All the clients share a single event
+    loop, so other tasks of the application can run next to the web server.
+
+    Example::
+
+        from microdot_asyncio import Microdot
+
+        app = Microdot()
+    """
+
+    async def start_server(self, host='0.0.0.0', port=5000, debug=False,
+                           ssl=None):
+        """Start the Microdot web server as a coroutine. This coroutine does
+        not normally return, as the server enters an endless listening loop.
+        The :func:`shutdown` function provides a method for terminating the
+        server gracefully.
+
+        :param host: The hostname or IP address of the network interface that
+                     will be listening for requests. A value of ``'0.0.0.0'``
+                     (the default) indicates that the server should listen for
+                     requests on all the available interfaces, and a value of
+                     ``127.0.0.1`` indicates that the server should listen
+                     for requests only on the internal networking interface of
+                     the host.
+        :param port: The port number to listen for requests. The default is
+                     port 5000.
+        :param debug: If ``True``, the server logs debugging information. The
+                      default is ``False``.
+        :param ssl: An ``SSLContext`` instance or ``None`` if the server should
+                    not use TLS. The default is ``None``.
+
+        This method is a coroutine.
+
+        Example::
+
+            import asyncio
+            from microdot_asyncio import Microdot
+
+            app = Microdot()
+
+            @app.route('/')
+            async def index(request):
+                return 'Hello, world!'
+
+            async def main():
+                await app.start_server(debug=True)
+
+            asyncio.run(main())
+        """
+        self.debug = debug
+
+        async def serve(reader, writer):
+            if not hasattr(writer, 'awrite'):  # pragma: no cover
+                # CPython provides the awrite and aclose methods in 3.8+
+                async def awrite(self, data):
+                    if isinstance(data, memoryview):
+                        # the data may be in a buffer that is reused
+                        data = bytes(data)
+                    self.write(data)
+                    await self.drain()
+
+                async def aclose(self):
+                    self.close()
+                    await self.wait_closed()
+
+                from types import MethodType
+                writer.awrite = MethodType(awrite, writer)
+                writer.aclose = MethodType(aclose, writer)
+
+            await self.handle_request(reader, writer)
+
+        if self.debug:  # pragma: no cover
+            print('Starting async server on {host}:{port}...'.format(
+                host=host, port=port))
+
+        try:
+            self.server = await asyncio.start_server(
+                serve, host, port, ssl=ssl, backlog=self.listen_backlog)
+        except TypeError:
+            self.server = await asyncio.start_server(
+                serve, host, port, backlog=self.listen_backlog)
+
+        while True:
+            try:
+                await self.server.wait_closed()
+                break
+            except AttributeError:  # pragma: no cover
+                # the task hasn't been initialized in the server object yet
+                # wait a bit and try again
+                await asyncio.sleep(0.1)
+
+    def run(self, host='0.0.0.0', port=5000, debug=False, ssl=None):
+        """Start the web server. This function does not normally return, as
+        the server enters an endless listening loop. The :func:`shutdown`
+        function provides a method for terminating the server gracefully.
+
+        :param host: The hostname or IP address of the network interface that
+                     will be listening for requests. A value of ``'0.0.0.0'``
+                     (the default) indicates that the server should listen for
+                     requests on all the available interfaces, and a value of
+                     ``127.0.0.1`` indicates that the server should listen
+                     for requests only on the internal networking interface of
+                     the host.
+        :param port: The port number to listen for requests. The default is
+                     port 5000.
+        :param debug: If ``True``, the server logs debugging information. The
+                      default is ``False``.
+        :param ssl: An ``SSLContext`` instance or ``None`` if the server should
+                    not use TLS. The default is ``None``.
+
+        Example::
+
+            from microdot_asyncio import Microdot
+
+            app = Microdot()
+
+            @app.route('/')
+            async def index(request):
+                return 'Hello, world!'
+
+            app.run(debug=True)
+        """
+        asyncio.run(self.start_server(host=host, port=port, debug=debug,
+                                      ssl=ssl))  # pragma: no cover
+
+    def shutdown(self):
+        self.server.close()
+
+    async def handle_request(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        conn = self._open_connection(ConnectionReader, reader)
+        reader, buf = conn
+        metrics = self.metrics
+        if metrics:
+            reader.clock = metrics.ticks
+        served = 0
+        keep_alive = True
+        while keep_alive:
+            req = None
+            keep_alive = False
+            try:
+                if served:
+                    req = await asyncio.wait_for(
+                        Request.create(self, reader, writer, addr),
+                        self.keep_alive_timeout)
+                else:
+                    req = await Request.create(self, reader, writer, addr)
+            except asyncio.TimeoutError:  # pragma: no cover
+                break  # idle persistent connection
+            except Exception as exc:  # pragma: no cover
+                print_exception(exc)
+            if req is None and served:
+                break  # the client closed the persistent connection
+
+            if metrics:
+                parsed = metrics.ticks()
+            res = await self.dispatch_request(req)
+            if metrics:
+                dispatched = metrics.ticks()
+            served += 1
+            try:
+                if res != Response.already_handled:  # pragma: no branch
+                    keep_alive = self._keep_alive(req, res, served)
+                    await res.write(writer, buf)
+                    if metrics and req:
+                        metrics.record(req, res, reader.received, parsed,
+                                       dispatched)
+            except OSError as exc:  # pragma: no cover
+                keep_alive = False
+                if exc.errno in MUTED_SOCKET_ERRORS:
+                    pass
+                else:
+                    raise
+            if self.debug and req:  # pragma: no cover
+                print('{method} {path} {status_code}'.format(
+                    method=req.method, path=req.path,
+                    status_code=res.status_code))
+            self._release(req, res)
+        self._close_connection(conn)
+        try:
+            await writer.aclose()
+        except OSError as exc:  # pragma: no cover
+            if exc.errno in MUTED_SOCKET_ERRORS:
+                pass
+            else:
+                raise
+
+    async def dispatch_request(self, req):
+        after_request_handled = False
+        if req:
+            if req.content_length > req.max_content_length:
+                if 413 in self.error_handlers:
+                    res = await self._invoke_handler(
+                        self.error_handlers[413], req)
+                else:
+                    res = 'Payload too large', 413
+            else:
+                f = self.find_route(req)
+                if callable(f) and self._low_memory(req):
+                    f = 503
+                try:
+                    res = None
+                    if callable(f):
+                        for handler in self.before_request_handlers:
+                            res = await self._invoke_handler(handler, req)
+                            if res:
+                                break
+                        if res is None:
+                            res = await self._invoke_handler(
+                                f, req, **req.url_args)
+                        if isinstance(res, tuple):
+                            body = res[0]
+                            if isinstance(res[1], int):
+                                status_code = res[1]
+                                headers = res[2] if len(res) > 2 else {}
+                            else:
+                                status_code = 200
+                                headers = res[1]
+                            res = Response._get(self._responses, body,
+                                                status_code, headers)
+                        elif not isinstance(res, Response):
+                            res = Response._get(self._responses, res)
+                        for handler in self.after_request_handlers:
+                            res = await self._invoke_handler(
+                                handler, req, res) or res
+                        for handler in req.after_request_handlers:
+                            res = await self._invoke_handler(
+                                handler, req, res) or res
+                        after_request_handled = True
+                    elif isinstance(f, dict):
+                        res = Response._get(self._responses, headers=f)
+                    elif f in self.error_handlers:
+                        res = await self._invoke_handler(
+                            self.error_handlers[f], req)
+                    elif f == 503:
+                        res = self._unavailable()
+                    else:
+                        res = 'Not found', f
+                except HTTPException as exc:
+                    if exc.status_code in self.error_handlers:
+                        res = await self._invoke_handler(
+                            self.error_handlers[exc.status_code], req)
+                    else:
+                        res = exc.reason, exc.status_code
+                except Exception as exc:
+                    print_exception(exc)
+                    exc_class = None
+                    res = None
+                    if exc.__class__ in self.error_handlers:
+                        exc_class = exc.__class__
+                    else:
+                        for c in mro(exc.__class__)[1:]:
+                            if c in self.error_handlers:
+                                exc_class = c
+                                break
+                    if exc_class:
+                        try:
+                            res = await self._invoke_handler(
+                                self.error_handlers[exc_class], req, exc)
+                        except Exception as exc2:  # pragma: no cover
+                            print_exception(exc2)
+                    if res is None and isinstance(exc, MemoryError):
+                        res = self._out_of_memory()
+                    if res is None:
+                        if 500 in self.error_handlers:
+                            res = await self._invoke_handler(
+                                self.error_handlers[500], req)
+                        else:
+                            res = 'Internal server error', 500
+        else:
+            if 400 in self.error_handlers:
+                res = await self._invoke_handler(self.error_handlers[400], req)
+            else:
+                res = 'Bad request', 400
+        if isinstance(res, tuple):
+            res = Response._get(self._responses, *res)
+        elif not isinstance(res, Response):
+            res = Response._get(self._responses, res)
+        if not after_request_handled:
+            for handler in self.after_error_request_handlers:
+                res = await self._invoke_handler(
+                    handler, req, res) or res
+        res.is_head = (req and req.method == 'HEAD')
+        return res
+
+    async def _invoke_handler(self, f_or_coro, *args, **kwargs):
+        ret = f_or_coro(*args, **kwargs)
+        if _iscoroutine(ret):
+            ret = await ret
+        return ret
+
+
+abort = Microdot.abort
+Response.already_handled = Response()
+redirect = Response.redirect
+send_file = Response.send_file
@@ -0,0 +1,171 @@
+"""
+microdot_asyncio_sse
+--------------------
+
+The ``microdot_asyncio_sse`` module adds support for Server-Sent Events to
+the ``asyncio`` version of Microdot.
+"""
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from microdot_asyncio import Response
+
+
+class _Flag:
+    # A flag that wakes up a waiting task. On MicroPython a ThreadSafeFlag is
+    # used, which can also be set from interrupt handlers.
+    def __init__(self):
+        if hasattr(asyncio, 'ThreadSafeFlag'):  # pragma: no cover
+            self.flag = asyncio.ThreadSafeFlag()
+        else:
+            self.flag = asyncio.Event()
+
+    def set(self):
+        self.flag.set()
+
+    async def wait(self):
+        await self.flag.wait()
+        if hasattr(self.flag, 'clear'):
+            self.flag.clear()
+
+
+def encode_event(data=None, event=None, event_id=None):
+    """Encode an event in the ``text/event-stream`` format.
+
+    :param data: The data of the event. Dictionaries and lists are encoded
+                 as JSON. Strings and bytes are sent as they are.
+    :param event: The event type, or ``None`` for a message event.
+    :param event_id: The id of the event, or ``None``.
+    """
+    if isinstance(data, (dict, list)):
+        data = json.dumps(data)
+    elif isinstance(data, bytes):
+        data = data.decode()
+    elif data is None:
+        data = ''
+    message = ''
+    if event_id is not None:
+        message += 'id: {}\n'.format(event_id)
+    if event is not None:
+        message += 'event: {}\n'.format(event)
+    for line in str(data).split('\n'):
+        message += 'data: {}\n'.format(line)
+    return (message + '\n').encode()
+
+
+class EventStream:
+    """The events queued for one subscriber of an :class:`EventChannel`.
+
+    This object is an asynchronous iterator that returns encoded events, and
+    is used as the body of a streaming response. When no event is sent for
+    ``keepalive`` seconds a comment line is returned instead, which allows
+    the server to detect clients that went away. With ``keepalive`` set to
+    ``None`` the stream waits for events indefinitely.
+    """
+    def __init__(self, channel, max_queue=8, keepalive=15):
+        self.channel = channel
+        self.max_queue = max_queue
+        self.keepalive = keepalive
+        self.queue = []
+        self.flag = _Flag()
+        self.closed = False
+
+    def put(self, message):
+        # slow subscribers lose their oldest events instead of holding memory
+        if len(self.queue) >= self.max_queue:
+            self.queue.pop(0)
+        self.queue.append(message)
+        self.flag.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.queue:
+            if self.closed:
+                raise StopAsyncIteration
+            if self.keepalive is None:
+                await self.flag.wait()
+                continue
+            try:
+                await asyncio.wait_for(self.flag.wait(), self.keepalive)
+            except asyncio.TimeoutError:
+                return b': keepalive\n\n'
+        return self.queue.pop(0)
+
+    async def aclose(self):
+        self.closed = True
+        self.channel.unsubscribe(self)
+
+
+class EventChannel:
+    """A channel of Server-Sent Events with any number of subscribers.
+
+    :param max_queue: The number of events that are queued for a subscriber
+                      that is not reading them. Older events are dropped.
+    :param keepalive: The number of seconds without events after which a
+                      keepalive comment is sent to the subscribers, or
+                      ``None`` to never send keepalive comments.
+    :param encoder: The function that encodes the events, with the signature
+                    of :func:`encode_event`, which is also the default.
+
+    Each event is encoded once when it is published, and the same encoded
+    message is queued for all the subscribers.
+
+    Example::
+
+        events = EventChannel()
+
+        @app.route('/events')
+        async def get_events(request):
+            return events.response()
+
+        events.publish('finish', {'elapsed_ms': 12345})
+    """
+    def __init__(self, max_queue=8, keepalive=15, encoder=encode_event):
+        self.max_queue = max_queue
+        self.keepalive = keepalive
+        self.encoder = encoder
+        self.subscribers = []
+
+    def subscribe(self):
+        """Add a subscriber to the channel, and return its
+        :class:`EventStream`."""
+        stream = EventStream(self, max_queue=self.max_queue,
+                             keepalive=self.keepalive)
+        self.subscribers.append(stream)
+        return stream
+
+    def unsubscribe(self, stream):
+        """Remove a subscriber from the channel."""
+        if stream in self.subscribers:
+            self.subscribers.remove(stream)
+
+    def publish(self, event=None, data=None, event_id=None):
+        """Send an event to all the subscribers of the channel.
+
+        :param event: The event type, or ``None`` for a message event.
+        :param data: The data of the event. Dictionaries and lists are encoded
+                     as JSON.
+        :param event_id: The id of the event, or ``None``.
+        """
+        if not self.subscribers:
+            return
+        message = self.encoder(data, event=event, event_id=event_id)
+        for stream in self.subscribers:
+            stream.put(message)
+
+    def response(self):
+        """Return a streaming response that subscribes the client to this
+        channel until it disconnects."""
+        return Response(self.subscribe(), headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+        })
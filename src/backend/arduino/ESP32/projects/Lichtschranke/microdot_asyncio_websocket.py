@@ -0,0 +1,272 @@
+"""
+microdot_asyncio_websocket
+--------------------------
+
+The ``microdot_asyncio_websocket`` module adds WebSocket support to the
+``asyncio`` version of Microdot.
+"""
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    import ubinascii as binascii
+except ImportError:
+    import binascii
+
+try:
+    import uhashlib as hashlib
+except ImportError:
+    import hashlib
+
+from microdot_asyncio import Response
+
+_WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class WebSocket:
+    """A WebSocket connection.
+
+    :param request: The request that was upgraded to a WebSocket connection.
+    """
+    CONT = 0
+    TEXT = 1
+    BINARY = 2
+    CLOSE = 8
+    PING = 9
+    PONG = 10
+
+    #: The maximum length of a received message. Longer messages close the
+    #: connection.
+    max_message_length = 4 * 1024
+
+    #: The number of seconds without any frame from the client after which
+    #: the server sends a ping, or ``None`` to wait for frames forever.
+    #: Example::
+    #:
+    #:    WebSocket.ping_interval = 20
+    ping_interval = None
+
+    #: The number of seconds the client has to send a frame, such as the pong
+    #: that answers the ping, before the connection is considered dead and
+    #: :meth:`receive` raises an ``OSError``.
+    ping_timeout = 10
+
+    def __init__(self, request):
+        self.request = request
+        self.closed = False
+
+    async def handshake(self):
+        response = self._handshake_response()
+        await self.request.sock[1].awrite(
+            b'HTTP/1.1 101 Switching Protocols\r\n'
+            b'Upgrade: websocket\r\n'
+            b'Connection: Upgrade\r\n'
+            b'Sec-WebSocket-Accept: ' + response + b'\r\n\r\n')
+
+    async def receive(self):
+        """Receive a message from the client. Text messages are returned as
+        strings, binary messages as bytes. Ping frames are answered while
+        waiting for a message. When :attr:`ping_interval` is set, a client
+        that does not send any frame for that long is pinged, and an
+        ``OSError`` is raised if it does not answer within
+        :attr:`ping_timeout` seconds.
+
+        This method is a coroutine.
+        """
+        while True:
+            opcode, payload = await self._read_frame()
+            send_opcode, data = self._process_websocket_frame(opcode, payload)
+            if send_opcode:  # pragma: no cover
+                await self.send(data, send_opcode)
+            elif data is not None:  # pragma: no branch
+                return data
+
+    async def send(self, data, opcode=None):
+        """Send a message to the client.
+
+        :param data: The message, as a string for a text message or as bytes
+                     for a binary message.
+        :param opcode: The frame opcode. The default is derived from the type
+                       of ``data``.
+
+        This method is a coroutine.
+        """
+        frame = self._encode_websocket_frame(
+            data,
+            opcode or (self.TEXT if isinstance(data, str) else self.BINARY))
+        await self.request.sock[1].awrite(frame)
+
+    async def ping(self, data=b''):
+        """Send a ping frame to the client. The client answers with a pong
+        frame, which is consumed by :meth:`receive`.
+
+        This method is a coroutine.
+        """
+        await self.send(data, self.PING)
+
+    async def close(self):
+        """Close the WebSocket connection.
+
+        This method is a coroutine.
+        """
+        if not self.closed:  # pragma: no cover
+            self.closed = True
+            await self.send(b'', self.CLOSE)
+
+    def _handshake_response(self):
+        headers = self.request.headers
+        if 'upgrade' not in headers.get('Connection', '').lower() or \
+                headers.get('Upgrade', '').lower() != 'websocket':
+            self.request.app.abort(400)
+        websocket_key = headers.get('Sec-WebSocket-Key')
+        if not websocket_key:
+            self.request.app.abort(400)
+        d = hashlib.sha1(websocket_key.encode())
+        d.update(_WEBSOCKET_GUID)
+        return binascii.b2a_base64(d.digest())[:-1]
+
+    @classmethod
+    def _parse_frame_header(cls, header):
+        fin = header[0] & 0x80
+        opcode = header[0] & 0x0f
+        if fin == 0 or opcode == cls.CONT:  # pragma: no cover
+            raise OSError(32, 'Continuation frames not supported')
+        has_mask = header[1] & 0x80
+        length = header[1] & 0x7f
+        if length == 126:
+            length = -2
+        elif length == 127:
+            length = -8
+        return fin, opcode, has_mask, length
+
+    def _process_websocket_frame(self, opcode, payload):
+        if opcode == self.TEXT:
+            payload = payload.decode()
+        elif opcode == self.BINARY:
+            pass
+        elif opcode == self.CLOSE:
+            raise OSError(32, 'Websocket connection closed')
+        elif opcode == self.PING:
+            return self.PONG, payload
+        elif opcode == self.PONG:  # pragma: no branch
+            return None, None
+        return None, payload
+
+    @classmethod
+    def _encode_websocket_frame(cls, data, opcode):
+        if isinstance(data, str):
+            data = data.encode()
+        if len(data) < 126:
+            frame = bytearray(2 + len(data))
+            frame[1] = len(data)
+            offset = 2
+        elif len(data) < (1 << 16):
+            frame = bytearray(4 + len(data))
+            frame[1] = 126
+            frame[2:4] = len(data).to_bytes(2, 'big')
+            offset = 4
+        else:  # pragma: no cover
+            frame = bytearray(10 + len(data))
+            frame[1] = 127
+            frame[2:10] = len(data).to_bytes(8, 'big')
+            offset = 10
+        frame[0] = 0x80 | opcode
+        frame[offset:] = data
+        return frame
+
+    async def _wait_frame(self, reader):
+        # wait for the first byte of the next frame, pinging an idle client;
+        # a cancelled single byte read consumes nothing, so the stream stays
+        # at a frame boundary
+        timeout = self.ping_interval
+        if timeout is None:
+            return await reader.readexactly(1)
+        pinged = False
+        while True:
+            try:
+                return await asyncio.wait_for(reader.readexactly(1), timeout)
+            except asyncio.TimeoutError:
+                if pinged:
+                    raise OSError(32, 'Websocket ping timeout')
+                await self.ping()
+                pinged = True
+                timeout = self.ping_timeout
+
+    async def _read_frame(self):
+        reader = self.request.sock[0]
+        try:
+            header = await self._wait_frame(reader)
+            header += await reader.readexactly(1)
+        except EOFError:  # pragma: no cover
+            raise OSError(32, 'Websocket connection closed')
+        fin, opcode, has_mask, length = self._parse_frame_header(header)
+        if length == -2:
+            length = await reader.readexactly(2)
+            length = int.from_bytes(length, 'big')
+        elif length == -8:
+            length = await reader.readexactly(8)
+            length = int.from_bytes(length, 'big')
+        if length > self.max_message_length:  # pragma: no cover
+            raise OSError(32, 'Websocket message too large')
+        if has_mask:  # pragma: no branch
+            mask = await reader.readexactly(4)
+        payload = bytearray(length)
+        await reader.readinto_exactly(payload)
+        if has_mask:  # pragma: no branch
+            for i in range(length):
+                payload[i] ^= mask[i & 3]
+        return opcode, bytes(payload)
+
+
+async def websocket_upgrade(request):
+    """Upgrade a request handler to a websocket connection.
+
+    This function can be called directly inside a route function to process a
+    WebSocket upgrade handshake, for example after the user's credentials are
+    verified. The function returns the websocket object::
+
+        @app.route('/echo')
+        async def echo(request):
+            if not authenticate_user(request):
+                abort(401)
+            ws = await websocket_upgrade(request)
+            while True:
+                message = await ws.receive()
+                await ws.send(message)
+    """
+    ws = WebSocket(request)
+    await ws.handshake()
+
+    @request.after_request
+    async def after_request(request, response):
+        return Response.already_handled
+
+    return ws
+
+
+def with_websocket(f):
+    """Decorator to make a route a WebSocket endpoint.
+
+    This decorator is used to define a route that accepts websocket
+    connections. The route then receives a websocket object as a second
+    argument that it can use to send and receive messages::
+
+        @app.route('/echo')
+        @with_websocket
+        async def echo(request, ws):
+            while True:
+                message = await ws.receive()
+                await ws.send(message)
+    """
+    async def wrapper(request, *args, **kwargs):
+        ws = await websocket_upgrade(request)
+        try:
+            await f(request, ws, *args, **kwargs)
+            await ws.close()  # pragma: no cover
+        except OSError as exc:
+            if exc.errno not in [32, 54, 104]:  # pragma: no cover
+                raise
+        return ''
+    return wrapper
@@ -0,0 +1,226 @@
+"""
+microdot_metrics
+----------------
+
+The ``microdot_metrics`` module records request counts, status codes and
+latency histograms for a Microdot application, and exposes them on an
+endpoint.
+"""
+from array import array
+import gc
+
+try:
+    import utime as time
+except ImportError:
+    import time
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+if hasattr(time, 'ticks_us'):  # pragma: no cover
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+else:
+    def ticks_us():
+        return time.perf_counter_ns() // 1000
+
+    def ticks_diff(end, start):
+        return end - start
+
+
+class Metrics:
+    """Request metrics for a Microdot application.
+
+    :param app: The application to instrument. If not given, the
+                :meth:`init_app` method must be called later.
+    :param url: The URL of the metrics endpoint, or ``None`` to not add an
+                endpoint. The endpoint returns the metrics in text form, or in
+                JSON when the ``format=json`` query string argument is given.
+
+    For each route the number of requests, the number of responses in each
+    status code class and histograms of the parse, dispatch and write times
+    are recorded. Requests that do not match a route are recorded together.
+    All the counters are kept in arrays that are allocated once, so that
+    recording a request does not allocate memory.
+
+    Example::
+
+        from microdot_asyncio import Microdot
+        from microdot_metrics import Metrics
+
+        app = Microdot()
+        Metrics(app)
+    """
+    #: The upper bounds of the histogram buckets, in microseconds. Durations
+    #: above the last bound are counted in an additional bucket.
+    buckets = (500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000,
+               500000, 1000000)
+
+    #: The phases of a request that are timed. The parse time goes from the
+    #: arrival of the request to the creation of the request object, the
+    #: dispatch time covers the handlers, and the write time covers the
+    #: sending of the response.
+    phases = ('parse', 'dispatch', 'write')
+
+    #: The status code classes that are counted.
+    status_classes = ('1xx', '2xx', '3xx', '4xx', '5xx')
+
+    def __init__(self, app=None, url='/metrics'):
+        self.app = None
+        self.routes = 0
+        self.requests = None
+        #: The number of connections that were rejected because the server
+        #: was busy.
+        self.rejected = 0
+        #: The number of requests that were answered with a ``503`` status
+        #: code because the free memory was below
+        #: :attr:`Microdot.min_free_memory <microdot.Microdot.min_free_memory>`
+        #: or the handler ran out of memory.
+        self.shed = 0
+        if app is not None:
+            self.init_app(app, url=url)
+
+    def init_app(self, app, url='/metrics'):
+        self.app = app
+        app.metrics = self
+        if url:
+            app.route(url)(self.handle_metrics)
+
+    @staticmethod
+    def ticks():
+        return ticks_us()
+
+    def _allocate(self):
+        # one slot for each route and one for the requests without a route
+        self.routes = len(self.app.url_map)
+        slots = self.routes + 1
+        self.requests = array('L', [0] * slots)
+        self.statuses = array('L', [0] * (slots * len(self.status_classes)))
+        self.histograms = array('L', [0] * (
+            slots * len(self.phases) * (len(self.buckets) + 1)))
+        # the sums of the durations are split in whole seconds and the
+        # remaining microseconds, so that they stay small integers
+        self.sum_seconds = array('L', [0] * (slots * len(self.phases)))
+        self.sum_micros = array('L', [0] * (slots * len(self.phases)))
+
+    def _bucket(self, us):
+        buckets = self.buckets
+        n = len(buckets)
+        i = 0
+        while i < n and us > buckets[i]:
+            i += 1
+        return i
+
+    def _observe(self, slot, phase, us):
+        i = slot * len(self.phases) + phase
+        self.histograms[i * (len(self.buckets) + 1) + self._bucket(us)] += 1
+        micros = self.sum_micros[i] + us
+        if micros >= 1000000:
+            self.sum_seconds[i] += micros // 1000000
+            micros %= 1000000
+        self.sum_micros[i] = micros
+
+    def _sum(self, slot, phase):
+        i = slot * len(self.phases) + phase
+        return self.sum_seconds[i] + self.sum_micros[i] / 1000000
+
+    def record(self, req, res, received, parsed, dispatched):
+        """Record a request that was answered. The arguments after the
+        response are the ticks at which the request started to arrive, was
+        parsed and was dispatched. The response is assumed to have been
+        written just now."""
+        written = ticks_us()
+        if self.requests is None:
+            self._allocate()
+        if req.route_index is None:
+            slot = self.routes
+        elif req.route_index < self.routes:
+            slot = req.route_index
+        else:  # pragma: no cover
+            # routes were added after the arrays were allocated, which
+            # resets the counters
+            self._allocate()
+            slot = req.route_index
+        self.requests[slot] += 1
+        status_class = min(max(res.status_code // 100 - 1, 0), 4)
+        self.statuses[slot * len(self.status_classes) + status_class] += 1
+        self._observe(slot, 0, ticks_diff(parsed, received))
+        self._observe(slot, 1, ticks_diff(dispatched, parsed))
+        self._observe(slot, 2, ticks_diff(written, dispatched))
+
+    def _route_name(self, slot):
+        if slot == self.routes:
+            return '-'
+        methods, pattern, _ = self.app.url_map[slot]
+        return ','.join(methods) + ' ' + pattern.url_pattern
+
+    def to_dict(self):
+        """Return the recorded metrics as a dictionary. Routes that did not
+        receive requests are omitted. On MicroPython the free heap memory is
+        included as well."""
+        routes = []
+        n = len(self.buckets) + 1
+        for slot in range(self.routes + 1 if self.requests else 0):
+            if not self.requests[slot]:
+                continue
+            offset = slot * len(self.phases) * n
+            s = slot * len(self.status_classes)
+            routes.append({
+                'route': self._route_name(slot),
+                'requests': self.requests[slot],
+                'status': {
+                    name: self.statuses[s + i]
+                    for i, name in enumerate(self.status_classes)
+                    if self.statuses[s + i]},
+                'histograms': {
+                    phase: list(self.histograms[offset + i * n:
+                                                offset + (i + 1) * n])
+                    for i, phase in enumerate(self.phases)},
+                'sums_s': {
+                    phase: self._sum(slot, i)
+                    for i, phase in enumerate(self.phases)},
+            })
+        metrics = {'buckets_us': list(self.buckets), 'rejected': self.rejected,
+                   'shed': self.shed, 'routes': routes}
+        if hasattr(gc, 'mem_free'):  # pragma: no cover
+            metrics['mem_free'] = gc.mem_free()
+        return metrics
+
+    def to_text(self):
+        """Return the recorded metrics in the text format used by
+        Prometheus."""
+        metrics = self.to_dict()
+        lines = ['microdot_rejected_total {}'.format(self.rejected),
+                 'microdot_shed_total {}'.format(self.shed)]
+        if 'mem_free' in metrics:  # pragma: no cover
+            lines.append('microdot_mem_free_bytes {}'.format(
+                metrics['mem_free']))
+        bounds = [str(b / 1000000) for b in self.buckets] + ['+Inf']
+        for route in metrics['routes']:
+            label = 'route="{}"'.format(route['route'])
+            lines.append('microdot_requests_total{{{}}} {}'.format(
+                label, route['requests']))
+            for name, count in route['status'].items():
+                lines.append(
+                    'microdot_responses_total{{{},status="{}"}} {}'.format(
+                        label, name, count))
+            for phase, counts in route['histograms'].items():
+                total = 0
+                for bound, count in zip(bounds, counts):
+                    total += count
+                    lines.append(
+                        'microdot_{}_seconds_bucket{{{},le="{}"}} {}'.format(
+                            phase, label, bound, total))
+                lines.append('microdot_{}_seconds_sum{{{}}} {}'.format(
+                    phase, label, route['sums_s'][phase]))
+                lines.append('microdot_{}_seconds_count{{{}}} {}'.format(
+                    phase, label, total))
+        return '\n'.join(lines) + '\n'
+
+    def handle_metrics(self, request):
+        if request.args.get('format') == 'json':
+            return json.dumps(self.to_dict()), 200, {
+                'Content-Type': 'application/json'}
+        return self.to_text(), 200, {'Content-Type': 'text/plain'}